@@ -14,6 +14,8 @@ import numpy as np
 sys.path.append(".//scripts")
 
 from classes.LoadArgsFromFile import LoadArgsFromFile
+from classes.AlignedFragments import AlignedFragments
+from classes.DensityStore import DensityStore
 from classes.Settings import AlignmentSettings
 from classes.Radii import Radii
 
@@ -22,7 +24,7 @@ from constants.colors import COLORS
 
 from helpers.plot_functions import plot_fragments
 
-from align_kabsch import split_file_if_too_big, align_all_fragments
+from align_kabsch import align_all_fragments
 from plot_density import make_density_plot
 from scripts.plot_avg_fragment import plot_avg_fragment
 from calc_avg_fragment import calc_avg_frag
@@ -31,10 +33,10 @@ from plot_fingerprint import make_fingerprint_plots
 
 from density_slider import make_density_slider_plot
 
-from helpers.density_helpers import make_density_df, find_available_volume
+from helpers.density_helpers import make_density_df, make_density_pyramid, find_available_volume
 from helpers.geometry_helpers import make_coordinate_df
 
-from constants.constants import STANDARD_RES, STANDARD_THRESHOLD, STANDARD_EXTRA_VDW
+from constants.constants import STANDARD_RES, STANDARD_THRESHOLD, STANDARD_EXTRA_VDW, MIN_RES, MAX_RES, RES_STEP
 
 # https://stackoverflow.com/questions/36827962/pep8-import-not-at-top-of-file-with-sys-path
 
@@ -47,15 +49,17 @@ def main():
     settings = make_settings_with_args(args)
 
     # Pipeline step 1: Align all fragments
-    aligned_df = align_all_fragments(settings)
+    aligned = align_all_fragments(settings, workers=(args.workers or 1), to_mean=bool(args.mean),
+                                  engine=(args.engine or "numpy"), rmse_cutoff=args.rmse_cutoff,
+                                  rmse_quantile=args.rmse_quantile, match_symmetry=not args.no_symmetry)
 
     # Pipeline step 2-3: Central group model
     radii = Radii(settings.get_radii_csv_name())
-    central_model = calc_avg_frag(aligned_df, settings, radii)
+    central_model = calc_avg_frag(aligned, settings, radii, method=(args.average or "mean"))
     central_model.to_csv(settings.get_avg_frag_filename(), index=False)
 
     # Pipeline step 4: Distance contact atom/center to the model
-    coordinate_df = make_coordinate_df(aligned_df, settings, central_model, radii)
+    coordinate_df = make_coordinate_df(aligned, settings, central_model, radii)
 
     # Pipeline step 5: Density calculation
     density_df = make_density_df(settings, coordinate_df)
@@ -81,18 +85,18 @@ def main():
     possible_inputs = [1, 2, 3, 4, 5, 6, 7]
     option = ask_int_input("What do you want to plot?", possible_inputs)
     while not option == 7:
-        perform_option(option, settings)
+        perform_option(option, settings, radii)
         print_menu()
         option = ask_int_input("What do you want to plot?", possible_inputs)
 
     print_epilog()
 
 
-def perform_option(option, settings):
+def perform_option(option, settings, radii):
     # do something
     if option == 1:
-        data = pd.read_csv(settings.get_aligned_csv_filename())
-        max_frags = len(data.fragment_id.unique())
+        aligned = AlignedFragments(settings).open()
+        max_frags = aligned.no_fragments
         possible_inputs = range(0, max_frags + 1)
         amount = ask_int_input("How many superimposed fragments would you like to plot?\n(Recommended < 100)\n",
                                possible_inputs)
@@ -101,8 +105,10 @@ def perform_option(option, settings):
         only_central = ask_bool_input("Do you want to plot the contact groups as well? [Y]\\N\n", default)
         print()
 
-        if "y" == only_central.lower():
-            data = data[data.label != "-"]
+        # only read the fragments that are plotted
+        part = "central" if "y" == only_central.lower() else None
+        data = aligned.to_dataframe(part, slice(0, amount))
+
         plot_fragments(data, amount, COLORS)
     elif option == 2:
         default = "Y"
@@ -114,40 +120,39 @@ def perform_option(option, settings):
         
         plot_avg_fragment(settings, labels)
     elif option == 3:
-        df = pd.read_csv(settings.get_aligned_csv_filename(), header=0)
+        aligned = AlignedFragments(settings).open()
         avg_frag = pd.read_csv(settings.outputfile_prefix + "_avg_fragment.csv", header=0)
-        make_fingerprint_plots(df, avg_frag, settings, STANDARD_EXTRA_VDW)
+        make_fingerprint_plots(aligned, avg_frag, settings, radii, STANDARD_EXTRA_VDW)
         print()
     elif option == 4:
         avg_fragment = pd.read_csv(settings.get_avg_frag_filename())
-        density_df = pd.read_hdf(settings.get_density_df_filename(), settings.get_density_df_key())
+        density_df = DensityStore(settings).open().to_dataframe(settings.resolution)
         make_density_plot(avg_fragment, density_df, settings)
     elif option == 5:
-        df = pd.read_csv(settings.get_aligned_csv_filename())
+        aligned = AlignedFragments(settings).open()
 
         avg_fragment = pd.read_csv(settings.get_avg_frag_filename())
 
-        radii = Radii(settings.get_radii_csv_name())
-        coordinate_df = make_coordinate_df(df, settings, avg_fragment, radii)
+        coordinate_df = make_coordinate_df(aligned, settings, avg_fragment, radii)
 
-        make_contact_rps_plot(avg_fragment, coordinate_df, settings)
+        make_contact_rps_plot(avg_fragment, coordinate_df, settings, radii)
     elif option == 6:
         default = "Y"
         confimation = ask_bool_input("The program still has to calculate non-standard resolutions." +
                                      "This may take some time. Do you want to continue? [Y]\\N\n", default)
         print()
         if (confimation.lower() == "y"):
-            alligned_df = pd.read_csv(settings.get_aligned_csv_filename())
+            aligned = AlignedFragments(settings).open()
             central_model = pd.read_csv(settings.get_avg_frag_filename())
-            radii = Radii(settings.get_radii_csv_name())
-            coordinate_df = make_coordinate_df(alligned_df, settings, central_model, radii)
-            for res in np.arange(0.2, 1.05, 0.05):
-                settings.set_resolution(res)
-                make_density_df(settings, coordinate_df)
+            coordinate_df = make_coordinate_df(aligned, settings, central_model, radii)
+
+            # all resolutions of the slider in one pass over the contact points
+            resolutions = np.arange(MIN_RES, MAX_RES + RES_STEP / 2, RES_STEP)
+            pyramid = make_density_pyramid(settings, coordinate_df, resolutions)
 
             settings.set_resolution(STANDARD_RES)
             avg_fragment = pd.read_csv(settings.get_avg_frag_filename())
-            make_density_slider_plot(avg_fragment, settings)
+            make_density_slider_plot(avg_fragment, pyramid, settings)
 
 
 def ask_bool_input(message, default):
@@ -242,9 +247,6 @@ def make_settings_with_args(args):
     settings.set_resolution(STANDARD_RES)
     settings.set_threshold(STANDARD_THRESHOLD)
 
-    split_file_if_too_big(settings.coordinate_file, settings.no_atoms)
-    settings.update_coordinate_filename()
-
     print(f"Find your results in the output folder: {settings.output_folder_central_group}\n")
 
     return settings
@@ -289,6 +291,20 @@ def initiate_parser():
                           splitted on underscores)')
     optional.add_argument('-o', '--output', help='prefix of the outputfile (default CENTRAL_CONTACT)')
     optional.add_argument('-vdw', '--vanderwaals', help='used van der waals tolerance (default 0.5)')
+    optional.add_argument('-w', '--workers', type=int, help='amount of processes used for the alignment\
+                          (default 1)')
+    optional.add_argument('-e', '--engine', choices=['numpy', 'numba', 'qcp'], help='implementation of the\
+                          superposition, kabsch in numpy or numba, or quaternions (default numpy)')
+    optional.add_argument('-rc', '--rmse_cutoff', type=float, help='leave out the fragments with an alignment rmse\
+                          above this value')
+    optional.add_argument('-rq', '--rmse_quantile', type=float, help='leave out the fragments with an alignment rmse\
+                          above this quantile of all rmses, e.g. 0.99')
+    optional.add_argument('-m', '--mean', action='store_true', default=None, help='align the fragments to the mean\
+                          central group instead of to the first fragment')
+    optional.add_argument('-a', '--average', choices=['mean', 'median', 'trimmed'], help='how the central groups are\
+                          averaged into the model, trimmed leaves out the outer 10%% of each coordinate (default mean)')
+    optional.add_argument('-ns', '--no_symmetry', action='store_true', default=None, help='do not reorder the\
+                          symmetric atoms of the central groups to match the first fragment')
 
     return parser
 
@@ -3,28 +3,27 @@
 # thesis in the Master Computational Science, University of Amsterdam, 2021.
 #
 # `align_kabsch.py` loads the coordinates of the fragments exported from a conquest query and aligns the central groups
-# with the kabsch algorithm. It then saves the new coordinates in a .csv file.
+# with the kabsch algorithm. It then saves the new coordinates in a memory mapped store.
 #
 # Author: Natasja Wezel
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
 import sys
-import os
 import time
 
-import pandas as pd
 import numpy as np
+import pandas as pd
 
+from classes.AlignedFragments import AlignedFragments
+from classes.AlignmentPool import AlignmentPool
 from classes.Settings import AlignmentSettings
+from constants.constants import CHUNK_SIZE, MAX_MEAN_ITERATIONS, MEAN_TOLERANCE
 from constants.paths import WORKDIR
-from constants.constants import MAX_DATAFILE_SIZE
-from tqdm import tqdm
 
-from helpers.general_helpers import split
-
-from helpers.alignment_helpers import (calc_rmse, kabsch_align,
-                                       perform_rotations, perform_translation,
-                                       read_raw_data)
+from helpers.alignment_helpers import (align_fragments, bin_atoms, find_inliers, find_rmse_cutoff,
+                                       find_symmetry_permutations, get_atom_symbols, iter_fragment_chunks,
+                                       match_symmetric_atoms, mirror_fragments, perform_rotations, perform_translation,
+                                       prepare_data, remove_alignment_outputs)
 
 
 def main():
@@ -39,9 +38,6 @@ def main():
 
     settings = AlignmentSettings(WORKDIR, coordinate_file)
 
-    split_file_if_too_big(settings.coordinate_file, settings.no_atoms)
-    settings.update_coordinate_filename()
-
     align_all_fragments(settings)
 
     t1 = time.time() - t0
@@ -49,153 +45,222 @@ def main():
     print("Duration: %.2f s." % t1)
 
 
-def align_all_fragments(settings, to_mirror=True, again=False):
-    # get filenames
-    aligned_csv_filename, structures_csv_filename = settings.get_aligned_csv_filenames()
+def align_all_fragments(settings, to_mirror=True, again=False, workers=1, to_mean=False, engine="numpy",
+                        rmse_cutoff=None, rmse_quantile=None, match_symmetry=True):
+    """ Aligns all fragments in the coordinate file and saves them in the aligned store. Fragments with an rmse above
+        rmse_cutoff, or above the rmse_quantile of the rmses of all fragments in the file, are never written to the
+        store. With match_symmetry, the symmetric atoms of each central group are first reordered to match the first
+        fragment. An existing store is only used if it was aligned with the same options. """
+
+    aligned = AlignedFragments(settings)
+    options = {'method': "kabsch", 'to_mirror': to_mirror, 'to_mean': to_mean, 'engine': engine,
+               'rmse_cutoff': rmse_cutoff, 'rmse_quantile': rmse_quantile, 'match_symmetry': match_symmetry}
 
     # check if already aligned
-    if not again and os.path.exists(aligned_csv_filename):
-        print("The fragments are already aligned")
-        return pd.read_csv(aligned_csv_filename)
+    if not again and aligned.exists():
+        if aligned.read_sidecar().options == options:
+            print("The fragments are already aligned")
+            return aligned.open()
+
+        print("The fragments were aligned with other options, aligning them again")
+
+    # the coordinate df and the densities of an earlier alignment do not belong to the new one
+    remove_alignment_outputs(settings)
+
+    # the coordinate file still contains the atoms that will be binned
+    no_atoms_file = settings.no_atoms
+    keep_atoms = bin_atoms(settings)
+
+    # with more than one worker the fragments of each chunk are divided over a pool of processes
+    pool = AlignmentPool(workers) if workers > 1 else None
+
+    try:
+        # the quantile needs the rmses of all fragments, so they are found first, without writing any fragment
+        if rmse_quantile is not None:
+            print(f"Finding the {rmse_quantile} quantile of the rmses of all fragments")
+            rmses = np.concatenate([structures.rmse.to_numpy() for structures, _, _ in
+                                    align_chunks(settings, no_atoms_file, keep_atoms, to_mirror, match_symmetry, pool,
+                                                 engine)])
+            rmse_cutoff = find_rmse_cutoff(rmses, rmse_cutoff, rmse_quantile)
+            print(f"Leaving out the fragments with an rmse above {rmse_cutoff:.5f}")
+
+        aligned.start_writing(settings.label_list, settings.no_atoms_central, options)
+        no_fragments = 0
+
+        for structures, fragments, atom_ids in align_chunks(settings, no_atoms_file, keep_atoms, to_mirror,
+                                                            match_symmetry, pool, engine):
+            # leave out the fragments that fit badly before they are written, the first fragment always fits
+            keep = find_inliers(structures.rmse.to_numpy(), rmse_cutoff)
+            aligned.add_removed(len(keep) - np.count_nonzero(keep))
+
+            # put back into the store, the first chunk overwrites the structures of an earlier alignment
+            aligned.append(fragments[keep], atom_ids[keep], get_atom_symbols(atom_ids[keep]))
+
+            mode, header = ('w', True) if no_fragments == 0 else ('a', False)
+            structures[keep].to_csv(settings.get_structure_csv_filename(), mode=mode, header=header, index=False)
+
+            no_fragments += np.count_nonzero(keep)
 
-    # TODO: count files
-    data, structures, data_matrix, first_fragment = rotate_first_fragment(settings, to_mirror)
+        aligned.close()
+        settings.set_no_fragments(no_fragments)
 
-    # align all fragments
-    structures, data_matrix = do_kabsch_align(settings, data_matrix, structures, first_fragment, to_mirror)
+        if rmse_cutoff is not None:
+            print(f"Removed {aligned.no_removed} of {no_fragments + aligned.no_removed} fragments with a high rmse")
 
-    # put back into df
-    data_matrix = data_matrix.T
-    x_vec, y_vec, z_vec = data_matrix[0], data_matrix[1], data_matrix[2]
-    data.x, data.y, data.z = x_vec, y_vec, z_vec
+        if to_mean:
+            align_to_mean(settings, aligned.open(mode='r+'), to_mirror, pool, engine)
+    finally:
+        # also stop the workers and free the shared memory if something goes wrong
+        if pool is not None:
+            pool.close()
 
-    # reindex the data to a more readable format
-    data = data.reindex(['fragment_id', '_id', 'symbol', 'label', 'x', 'y', 'z'], axis=1)
+    return aligned.open()
 
-    # save as csv
-    structures.to_csv(structures_csv_filename, index=False)
-    data.to_csv(aligned_csv_filename, index=False)
 
-    return data
+def align_chunks(settings, no_atoms_file, keep_atoms, to_mirror, match_symmetry, pool=None, engine="numpy"):
+    """ Reads and aligns the fragments chunk by chunk, so the memory needed does not depend on the size of the file.
+        Yields the structures, the aligned fragments with shape (fragments, atoms, 3) and the atom ids of each chunk.
+        """
 
+    no_fragments, first_fragment, no_reordered = 0, None, 0
 
-# TODO: move too settings class
-def split_file_if_too_big(filename, no_atoms):
-    # do a filesize check
-    filesize = os.path.getsize(filename)
+    for chunk in iter_fragment_chunks(settings.coordinate_file, no_atoms_file):
+        structures, data_matrix, atom_ids = prepare_data(settings, chunk, keep_atoms)
 
-    # if file bigger than max size, split it into several files
-    if filesize > MAX_DATAFILE_SIZE:
-        print("Splitting original datafile...")
-        output_name_template = filename.rsplit('.', 1)[0] + '_%s.' + filename.rsplit('.', 1)[1]
+        if first_fragment is None:
+            structures, data_matrix, first_fragment = rotate_first_fragment(settings, data_matrix, structures,
+                                                                            to_mirror)
+            permutations = find_permutations(settings, first_fragment, atom_ids[0], match_symmetry)
 
-        # split after fragments, each fragment has no_atoms + 1 header line
-        row_limit = 6e6 - (6e6 % (no_atoms + 1))
+        # give symmetric atoms the same label as the atom of the first fragment they lie closest to
+        start = 1 if no_fragments == 0 else 0
+        no_reordered += match_symmetric_atoms(first_fragment, data_matrix.reshape(-1, settings.no_atoms, 3)[start:],
+                                              atom_ids[start:], permutations)
 
-        # splits if file is too big
-        split(open(filename), delimiter=',', row_limit=row_limit,
-              output_name_template=output_name_template, output_path='.')
+        # align all fragments, the first fragment of the first chunk is already in place
+        structures, data_matrix = do_kabsch_align(settings, data_matrix, structures, first_fragment, to_mirror,
+                                                  start=start, pool=pool, engine=engine)
 
+        no_fragments += len(structures)
 
-def rotate_first_fragment(settings, to_mirror):
-    data, structures = read_raw_data(settings.coordinate_file, settings.no_atoms)
+        yield structures, data_matrix.reshape(-1, settings.no_atoms, 3), atom_ids
 
-    # bin atoms to be binned
-    settings, fragments, data = prepare_data(settings, data)
+    if len(permutations) > 1:
+        print(f"Reordered the symmetric atoms of {no_reordered} fragments")
 
-    # restructure df to matrix
-    data_matrix = np.array([np.array(data.x), np.array(data.y), np.array(data.z)]).T
-    A = data_matrix[:settings.no_atoms]
+
+def rotate_first_fragment(settings, data_matrix, structures, to_mirror):
+    A = data_matrix[np.newaxis, :settings.no_atoms]
 
     # translate and rotate first fragment onto the origin as for nice viewing
-    A = perform_translation(A.copy(), settings.get_index_alignment_atom('center'))
-    A = perform_rotations(A.copy(), [settings.get_index_alignment_atom('yaxis'),
-                                     settings.get_index_alignment_atom('xyplane')])
+    A = perform_translation(A, settings.get_index_alignment_atom('center'))
+    A = perform_rotations(A, [settings.get_index_alignment_atom('yaxis'),
+                              settings.get_index_alignment_atom('xyplane')])
 
     if to_mirror:
-        mirrored, A = mirror(A)
-
-        if mirrored:
-            structures.loc[structures.index == 0, 'mirrored'] = True
+        mirrored, A = mirror_fragments(A)
+        structures.loc[0, 'mirrored'] = mirrored[0]
 
-    data_matrix[:settings.no_atoms] = A
+    data_matrix[:settings.no_atoms] = A[0]
 
     A = data_matrix[0:settings.no_atoms_central]
 
-    return data, structures, data_matrix, A
+    return structures, data_matrix, A
 
 
-def mirror(matrix):
-    # if mean of z is negative, reflect the whole fragment
-    if matrix[:, 2].mean() < 0:
-        # mirror by switching signs of z coordinate
-        matrix[:, 2] *= -1
+def find_permutations(settings, A, atom_ids, match_symmetry):
+    """ Returns the symmetry permutations of central group A, or only the identity if the atoms are not matched. """
 
-        return True, matrix
+    if not match_symmetry:
+        return np.arange(settings.no_atoms_central)[np.newaxis]
 
-    return False, matrix
+    symbols = get_atom_symbols(atom_ids[:settings.no_atoms_central])
+    permutations = find_symmetry_permutations(A, settings.label_list[:settings.no_atoms_central], symbols)
 
+    print(f"Central group has {len(permutations)} symmetry permutations")
+
+    return permutations
 
-def do_kabsch_align(settings, data_matrix, structures, A, to_mirror):
-    no_atoms = settings.no_atoms
-    no_atoms_central = settings.no_atoms_central
 
-    n = A.shape[0]
+def do_kabsch_align(settings, data_matrix, structures, A, to_mirror, start=1, pool=None, engine="numpy"):
+    # view the matrix as a stack of fragments, so they can all be aligned at once
+    fragments = data_matrix.reshape(-1, settings.no_atoms, 3)
 
     print("Applying Kabsch Algorithm...")
-    for i in tqdm(range(1, settings.get_no_fragments())):
-        B_central = data_matrix[i * no_atoms:no_atoms_central + i * no_atoms]
-        B_total = data_matrix[i * no_atoms: (i + 1) * no_atoms]
+    if pool is None:
+        mirrored, rmses = align_fragments(A, fragments[start:], settings.no_atoms_central, to_mirror, engine)
+    else:
+        mirrored, rmses = pool.align(A, fragments[start:], settings.no_atoms_central, to_mirror, engine)
 
-        # run kabsch, shift frame in data each time
-        B_total = kabsch_align(A, B_central, B_total, n)
+    if to_mirror:
+        structures.loc[start:, 'mirrored'] = mirrored
 
-        if to_mirror:
-            mirrored, B_total = mirror(B_total)
+    # save errors
+    structures.loc[start:, 'rmse'] = rmses
 
-            if mirrored:
-                structures.loc[structures.index == i, 'mirrored'] = True
+    return structures, data_matrix
 
-        # calculate and save error
-        rmse = calc_rmse(A, B_total[:no_atoms_central], n)
-        structures.loc[structures.index == i, 'rmse'] = rmse
 
-        # put back into overall matrix
-        data_matrix[i * no_atoms: (i + 1) * no_atoms] = B_total
+def align_to_mean(settings, aligned, to_mirror, pool=None, engine="numpy"):
+    """ Generalized procrustes: aligns all fragments to the mean of the central groups instead of to the first fragment,
+        recalculates the mean and repeats until the mean rmse does not change anymore. The store is changed in place,
+        and the rmse in the structures file is the rmse to the final mean. """
 
-    return structures, data_matrix
+    no_atoms_central = settings.no_atoms_central
+
+    structures = pd.read_csv(settings.get_structure_csv_filename())
+    previous_rmse = structures.rmse.mean()
+
+    print(f"Aligning to the mean, starting mean rmse {previous_rmse:.5f}")
+    for iteration in range(1, MAX_MEAN_ITERATIONS + 1):
+        t0 = time.time()
+
+        mean_fragment = calc_mean_central_group(aligned)
+        mirrored, rmses = [], []
+
+        # one pass over the store, chunk by chunk
+        for start in range(0, aligned.no_fragments, CHUNK_SIZE):
+            fragments = np.array(aligned.coordinates[start:start + CHUNK_SIZE])
+
+            if pool is None:
+                results = align_fragments(mean_fragment, fragments, no_atoms_central, to_mirror, engine)
+            else:
+                results = pool.align(mean_fragment, fragments, no_atoms_central, to_mirror, engine)
+
+            aligned.coordinates[start:start + CHUNK_SIZE] = fragments
+            mirrored.append(results[0])
+            rmses.append(results[1])
 
+        # a fragment that is mirrored twice is not mirrored anymore
+        structures['mirrored'] = structures.mirrored.to_numpy() ^ np.concatenate(mirrored)
+        structures['rmse'] = np.concatenate(rmses)
 
-def prepare_data(settings, data):
-    amount_rows = len(data)
+        mean_rmse = structures.rmse.mean()
+        change = abs(previous_rmse - mean_rmse)
+        previous_rmse = mean_rmse
 
-    # calc amount of fragments
-    no_fragments = int(amount_rows / settings.no_atoms)
+        print(f"Iteration {iteration}: mean rmse {mean_rmse:.5f}, max rmse {structures.rmse.max():.5f}, "
+              f"change {change:.2e}, {time.time() - t0:.2f} s")
 
-    settings.set_no_fragments(no_fragments)
+        if change < MEAN_TOLERANCE:
+            print(f"Converged after {iteration} iterations")
+            break
+    else:
+        print(f"Not converged after {MAX_MEAN_ITERATIONS} iterations")
 
-    # give each fragment a unique id
-    fragment_ids = range(0, no_fragments)
-    fragment_ids = np.repeat(fragment_ids, settings.no_atoms)
-    data['fragment_id'] = fragment_ids
+    aligned.coordinates.flush()
+    structures.to_csv(settings.get_structure_csv_filename(), index=False)
 
-    # give each atom in each fragment their label from conquest
-    labels = settings.label_list * no_fragments
-    data['label'] = labels
 
-    # TODO: decide if you want to give the posibility of ignoring atoms during alignment
-    # Then you would have to also add them again later.
-    if settings.alignment['bin'] != '-':
-        print(f"Throwing away {len(settings.alignment['bin'])} atoms.")
-        settings.no_atoms -= len(settings.alignment['bin'])
-        settings.no_atoms_central -= len(settings.alignment['bin'])
+def calc_mean_central_group(aligned):
+    """ Calculates the mean coordinates of each atom of the central group over all fragments in the store. """
 
-        for label in settings.alignment['bin']:
-            settings.label_list.remove(label)
+    total = np.zeros((aligned.no_atoms_central, 3))
 
-        data = data[~data.label.isin(settings.alignment['bin'])].reset_index()
+    for start in range(0, aligned.no_fragments, CHUNK_SIZE):
+        total += aligned.coordinates[start:start + CHUNK_SIZE, :aligned.no_atoms_central].sum(axis=0)
 
-    return settings, no_fragments, data
+    return total / aligned.no_fragments
 
 
 if __name__ == "__main__":
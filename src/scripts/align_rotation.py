@@ -3,25 +3,21 @@
 # thesis in the Master Computational Science, University of Amsterdam, 2021.
 #
 # `align_rotation` loads the coordinates of the fragments exported from a conquest query and aligns the central groups
-# by using rotation matrices and other linear algebra. It then saves the new coordinates in a .csv file.
+# by using rotation matrices and other linear algebra. It then saves the new coordinates in a memory mapped store.
 #
 # Author: Natasja Wezel
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
 import sys
-import os
 import time
 
-import numpy as np
+from classes.AlignedFragments import AlignedFragments
 from classes.Settings import AlignmentSettings
-from constants.paths import CENTRAL_GROUPS_CSV, WORKDIR
-from constants.constants import MAX_DATAFILE_SIZE
-from tqdm import tqdm
+from constants.paths import WORKDIR
 
-from helpers.general_helpers import split
-
-from helpers.alignment_helpers import (calc_rmse, perform_rotations, perform_translation,
-                                       read_raw_data)
+from helpers.alignment_helpers import (bin_atoms, calc_rmse, get_atom_symbols, iter_fragment_chunks,
+                                       mirror_fragments, perform_rotations, perform_translation, prepare_data,
+                                       remove_alignment_outputs)
 
 
 def main():
@@ -33,14 +29,8 @@ def main():
     t0 = time.time()
 
     coordinate_file = sys.argv[1]
-    labelfile = coordinate_file.rsplit('.', 1)[0] + '.csv'
-
-    settings = AlignmentSettings(WORKDIR, coordinate_file, labelfile)
 
-    settings.set_central_group_csv(CENTRAL_GROUPS_CSV)
-
-    split_file_if_too_big(settings.coordinate_file, settings.no_atoms)
-    settings.update_coordinate_filename()
+    settings = AlignmentSettings(WORKDIR, coordinate_file)
 
     align_all_fragments(settings)
 
@@ -49,149 +39,70 @@ def main():
     print("Duration: %.2f s." % t1)
 
 
-def align_all_fragments(settings, to_mirror=True):
-    # get filenames
-    aligned_csv_filename, structures_csv_filename = settings.get_aligned_csv_filenames()
+def align_all_fragments(settings, to_mirror=True, again=False):
+    aligned = AlignedFragments(settings)
+    options = {'method': "rotation", 'to_mirror': to_mirror}
 
     # check if already aligned
-    if os.path.exists(aligned_csv_filename):
-        print("The fragments are already aligned")
-        return
-
-    # TODO: count files
-    data, structures, data_matrix, first_fragment = rotate_first_fragment(settings, to_mirror)
-
-    # align all fragments
-    structures, data_matrix = do_rotation_align(settings, data_matrix, structures, first_fragment, to_mirror)
-
-    # put back into df
-    data_matrix = data_matrix.T
-    x_vec, y_vec, z_vec = data_matrix[0], data_matrix[1], data_matrix[2]
-    data.x, data.y, data.z = x_vec, y_vec, z_vec
-
-    # reindex the data to a more readable format
-    data = data.reindex(['fragment_id', '_id', 'symbol', 'label', 'x', 'y', 'z'], axis=1)
-
-    # save as csv
-    structures.to_csv(structures_csv_filename, index=False)
-    data.to_csv(aligned_csv_filename, index=False)
+    if not again and aligned.exists():
+        if aligned.read_sidecar().options == options:
+            print("The fragments are already aligned")
+            return aligned.open()
 
+        print("The fragments were aligned with other options, aligning them again")
 
-def split_file_if_too_big(filename, no_atoms):
-    # do a filesize check
-    filesize = os.path.getsize(filename)
+    # the coordinate df and the densities of an earlier alignment do not belong to the new one
+    remove_alignment_outputs(settings)
 
-    # if file bigger than max size, split it into several files
-    if filesize > MAX_DATAFILE_SIZE:
-        print("Splitting original datafile...")
-        output_name_template = filename.rsplit('.', 1)[0] + '_%s.' + filename.rsplit('.', 1)[1]
+    # the coordinate file still contains the atoms that will be binned
+    no_atoms_file = settings.no_atoms
+    keep_atoms = bin_atoms(settings)
 
-        # split after fragments, each fragment has no_atoms + 1 header line
-        row_limit = 6e6 - (6e6 % (no_atoms + 1))
+    aligned.start_writing(settings.label_list, settings.no_atoms_central, options)
+    no_fragments, first_fragment = 0, None
 
-        # TODO: make sure it doesn't split if file is small enough
-        split(open(filename), delimiter=',', row_limit=row_limit,
-              output_name_template=output_name_template, output_path='.')
+    # read and align the fragments chunk by chunk, so the memory needed does not depend on the size of the file
+    for chunk in iter_fragment_chunks(settings.coordinate_file, no_atoms_file):
+        structures, data_matrix, atom_ids = prepare_data(settings, chunk, keep_atoms)
 
+        structures, data_matrix = do_rotation_align(settings, data_matrix, structures, to_mirror)
 
-def rotate_first_fragment(settings, to_mirror):
-    data, structures = read_raw_data(settings.coordinate_file, settings.no_atoms)
+        # the rmse is calculated with respect to the very first fragment
+        if first_fragment is None:
+            first_fragment = data_matrix[:settings.no_atoms_central].copy()
 
-    # bin atoms to be binned
-    settings, fragments, data = prepare_data(settings, data)
+        fragments = data_matrix.reshape(-1, settings.no_atoms, 3)
+        structures['rmse'] = calc_rmse(first_fragment, fragments[:, :settings.no_atoms_central],
+                                       settings.no_atoms_central)
 
-    # restructure df to matrix
-    data_matrix = np.array([np.array(data.x), np.array(data.y), np.array(data.z)]).T
-    A = data_matrix[:settings.no_atoms]
+        aligned.append(fragments, atom_ids, get_atom_symbols(atom_ids))
 
-    # translate and rotate first fragment onto the origin as for nice viewing
-    A = perform_translation(A.copy(), settings.get_index_alignment_atom('center'))
-    A = perform_rotations(A.copy(), [settings.get_index_alignment_atom('yaxis'),
-                                     settings.get_index_alignment_atom('xyplane')])
+        mode, header = ('w', True) if no_fragments == 0 else ('a', False)
+        structures.to_csv(settings.get_structure_csv_filename(), mode=mode, header=header, index=False)
 
-    if to_mirror:
-        mirrored, A = mirror(A)
-
-        if mirrored:
-            structures.loc[structures.index == 0, 'mirrored'] = True
-
-    data_matrix[:settings.no_atoms] = A
-
-    A = data_matrix[0:settings.no_atoms_central]
+        no_fragments += len(structures)
 
-    return data, structures, data_matrix, A
-
-
-def mirror(matrix):
-    # if mean of z is negative, reflect the whole fragment
-    if matrix[:, 2].mean() < 0:
-        # mirror by switching signs of z coordinate
-        matrix[:, 2] *= -1
-
-        return True, matrix
+    aligned.close()
+    settings.set_no_fragments(no_fragments)
 
-    return False, matrix
+    return aligned.open()
 
 
-def do_rotation_align(settings, data_matrix, structures, A, to_mirror):
-    no_atoms = settings.no_atoms
-    no_atoms_central = settings.no_atoms_central
+def do_rotation_align(settings, data_matrix, structures, to_mirror):
+    """ Translates and rotates all fragments in the data matrix onto the origin at once. """
 
-    n = A.shape[0]
+    fragments = data_matrix.reshape(-1, settings.no_atoms, 3)
 
     print("Rotating all fragments...")
-    for i in tqdm(range(1, settings.get_no_fragments())):
-        B_total = data_matrix[i * no_atoms: (i + 1) * no_atoms]
+    fragments = perform_translation(fragments, settings.get_index_alignment_atom('center'))
+    fragments = perform_rotations(fragments, [settings.get_index_alignment_atom('yaxis'),
+                                              settings.get_index_alignment_atom('xyplane')])
 
-        # translate and rotate fragments onto the origin
-        B_total = perform_translation(B_total.copy(), settings.get_index_alignment_atom('center'))
-        B_total = perform_rotations(B_total.copy(), [settings.get_index_alignment_atom('yaxis'),
-                                    settings.get_index_alignment_atom('xyplane')])
-
-        if to_mirror:
-            mirrored, B_total = mirror(B_total)
-
-            if mirrored:
-                structures.loc[structures.index == i, 'mirrored'] = True
-
-        # calculate and save error
-        rmse = calc_rmse(A, B_total[:no_atoms_central], n)
-        structures.loc[structures.index == i, 'rmse'] = rmse
-
-        # put back into overall matrix
-        data_matrix[i * no_atoms: (i + 1) * no_atoms] = B_total
-
-    return structures, data_matrix
-
-
-def prepare_data(settings, data):
-    amount_rows = len(data)
-
-    # calc amount of fragments
-    no_fragments = int(amount_rows / settings.no_atoms)
-
-    settings.set_no_fragments(no_fragments)
-
-    # give each fragment a unique id
-    fragment_ids = range(0, no_fragments)
-    fragment_ids = np.repeat(fragment_ids, settings.no_atoms)
-    data['fragment_id'] = fragment_ids
-
-    # give each atom in each fragment their label from conquest
-    labels = settings.label_list * no_fragments
-    data['label'] = labels
-
-    if settings.alignment['bin'] != '-':
-        print(f"Throwing away {len(settings.alignment['bin'])} atoms.")
-        settings.no_atoms -= len(settings.alignment['bin'])
-        settings.no_atoms_central -= len(settings.alignment['bin'])
-
-        for label in settings.alignment['bin']:
-            settings.label_list.remove(label)
-
-        data = data[~data.label.isin(settings.alignment['bin'])].reset_index()
+    if to_mirror:
+        mirrored, fragments = mirror_fragments(fragments)
+        structures['mirrored'] = mirrored
 
-    return settings, no_fragments, data
+    return structures, fragments.reshape(-1, 3)
 
 
 if __name__ == "__main__":
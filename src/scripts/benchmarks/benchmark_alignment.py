@@ -0,0 +1,132 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# This script is part of the quantification pipeline of 3D experimental data of crystal structures that I wrote for my
+# thesis in the Master Computational Science, University of Amsterdam, 2021.
+#
+# `benchmark_alignment.py` times the alignment engines on random fragments, so the timings can be reproduced on other
+# machines. The fragments are rotated copies of one random fragment with noise on the atoms, and the same seed is always
+# used.
+#
+# Author: Natasja Wezel
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+import argparse
+import contextlib
+import io
+import os
+import sys
+import time
+
+import numpy as np
+import pandas as pd
+
+# so we can import the scripts from the folder above
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from align_kabsch import do_kabsch_align
+from helpers.alignment_helpers import align_fragments
+from helpers.superposition_helpers import qcp_rmsd_numba
+
+
+ENGINES = ["numpy", "numba", "qcp"]
+
+
+class BenchmarkSettings():
+    """ The part of the settings that the alignment uses. """
+
+    def __init__(self, no_atoms, no_atoms_central):
+        self.no_atoms = no_atoms
+        self.no_atoms_central = no_atoms_central
+
+
+def main():
+
+    parser = argparse.ArgumentParser(description="Times the alignment on random fragments.")
+    parser.add_argument('-n', '--no_fragments', type=int, nargs='+', default=[10000, 100000, 1000000],
+                        help='amounts of fragments to align (default 10000 100000 1000000)')
+    parser.add_argument('-a', '--no_atoms', type=int, default=14, help='atoms per fragment (default 14)')
+    parser.add_argument('-c', '--no_atoms_central', type=int, default=6,
+                        help='atoms in the central group (default 6)')
+    args = parser.parse_args()
+
+    settings = BenchmarkSettings(args.no_atoms, args.no_atoms_central)
+
+    # compile the kernels first, so the compilation is not timed
+    for engine in ENGINES:
+        time_engine(make_fragments(10, args.no_atoms, args.no_atoms_central), args.no_atoms_central, engine)
+    time_qcp_rmsd(make_fragments(10, args.no_atoms, args.no_atoms_central), args.no_atoms_central)
+
+    print(f"{args.no_atoms} atoms per fragment, {args.no_atoms_central} central atoms, times in seconds")
+    print(f"{'fragments':>10}{'bookkeeping':>14}" + "".join(f"{engine:>10}" for engine in ENGINES) +
+          f"{'qcp rmsd':>10}")
+
+    for no_fragments in args.no_fragments:
+        fragments = make_fragments(no_fragments, args.no_atoms, args.no_atoms_central)
+
+        times = [time_bookkeeping(settings, fragments)]
+        times += [time_engine(fragments, args.no_atoms_central, engine) for engine in ENGINES]
+        times += [time_qcp_rmsd(fragments, args.no_atoms_central)]
+
+        print(f"{no_fragments:>10}{times[0]:>14.2f}" + "".join(f"{duration:>10.2f}" for duration in times[1:]))
+
+
+def make_fragments(no_fragments, no_atoms, no_atoms_central, seed=0):
+    """ Returns randomly rotated and moved copies of a random fragment, with noise on the atoms, with shape
+        (fragments, atoms, 3). """
+
+    rng = np.random.default_rng(seed)
+
+    fragment = rng.normal(size=(no_atoms, 3))
+    fragments = fragment + rng.normal(scale=0.1, size=(no_fragments, no_atoms, 3))
+    fragments[:, no_atoms_central:] = rng.normal(size=(no_fragments, no_atoms - no_atoms_central, 3))
+
+    # a random rotation per fragment, from the QR decomposition of a random matrix
+    Q, R = np.linalg.qr(rng.normal(size=(no_fragments, 3, 3)))
+    rotations = Q * np.sign(np.diagonal(R, axis1=1, axis2=2))[:, np.newaxis]
+
+    return np.einsum('fij,faj->fai', rotations, fragments) + rng.normal(size=(no_fragments, 1, 3))
+
+
+def time_bookkeeping(settings, fragments):
+    """ Times do_kabsch_align, which aligns the fragments and puts the rmses and mirror flags in the structures df. """
+
+    A = fragments[0, :settings.no_atoms_central].copy()
+    data_matrix = fragments.reshape(-1, 3).copy()
+    structures = pd.DataFrame({'structure_id': np.arange(len(fragments)), 'rmse': 0.0, 'mirrored': False})
+
+    # without the progress message, which would break the table
+    with contextlib.redirect_stdout(io.StringIO()):
+        t0 = time.time()
+        do_kabsch_align(settings, data_matrix, structures, A, to_mirror=True)
+        duration = time.time() - t0
+
+    return duration
+
+
+def time_engine(fragments, no_atoms_central, engine):
+    """ Times the alignment of the fragments onto the central group of the first fragment with an engine of
+        align_fragments, including the rmse. """
+
+    A = fragments[0, :no_atoms_central].copy()
+    fragments = fragments.copy()
+
+    t0 = time.time()
+    align_fragments(A, fragments, no_atoms_central, to_mirror=False, engine=engine)
+
+    return time.time() - t0
+
+
+
+def time_qcp_rmsd(fragments, no_atoms_central):
+    """ Times the rmsd after superposition with the QCP method, which does not build the rotations. """
+
+    A = fragments[0, :no_atoms_central].copy()
+    central_groups = np.ascontiguousarray(fragments[:, :no_atoms_central])
+
+    t0 = time.time()
+    qcp_rmsd_numba(A, central_groups, no_atoms_central)
+
+    return time.time() - t0
+
+
+if __name__ == "__main__":
+    main()
@@ -7,17 +7,20 @@
 # Author: Natasja Wezel
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
+import json
 import sys
 import pandas as pd
 
+from classes.AlignedFragments import AlignedFragments
 from classes.Settings import Settings
 from classes.Radii import Radii
-from helpers.geometry_helpers import average_fragment, add_model_methyl
+from helpers.geometry_helpers import (add_model_methyl, add_radii, assign_nearest_centres, average_fragment,
+                                     calc_average, count_R_elements)
 from helpers.alignment_helpers import calc_rmse
 
-from constants.constants import RMSE_TEST
+from constants.constants import CHUNK_SIZE, RMSE_TEST
 
-from sklearn.cluster import KMeans
+from sklearn.cluster import MiniBatchKMeans
 
 from constants.paths import WORKDIR
 
@@ -33,36 +36,35 @@ def main():
     inputfilename = sys.argv[1]
 
     avg_frag_settings = Settings(WORKDIR, inputfilename)
-    df = pd.read_csv(avg_frag_settings.get_aligned_csv_filename(), header=0)
+    aligned = AlignedFragments(avg_frag_settings).open()
 
     # make radii object to get vdw radii
     radii = Radii(avg_frag_settings.get_radii_csv_name())
 
-    fragment = calc_avg_frag(df, avg_frag_settings, radii)
+    fragment = calc_avg_frag(aligned, avg_frag_settings, radii)
 
     # get name and save average fragment
     avg_frag_file = avg_frag_settings.get_avg_frag_filename()
     fragment.to_csv(avg_frag_file, index=False)
 
 
-def calc_avg_frag(df, avg_frag_settings, radii):
-    fragment = average_fragment(df, avg_frag_settings, radii)
+def calc_avg_frag(aligned, avg_frag_settings, radii, method="mean"):
+    fragment = average_fragment(aligned, radii, method)
 
     # test
     calc_kabsch_rmse(avg_frag_settings)
-    rmse_avg = calc_avg_rmse(fragment, avg_frag_settings)
+    distribution = calc_avg_rmse(fragment, aligned, avg_frag_settings)
 
-    # dependent on rmses, do kmeans or not
-    if rmse_avg > RMSE_TEST:
+    # the symmetric atoms are matched during the alignment, relabelling is only needed if that did not work out
+    if distribution['mean'] > RMSE_TEST:
         print("RMSEs too high. Resetting labels using KMeans")
-        df = reset_labels_with_kmeans(df, avg_frag_settings)
+        fragment = relabel_with_kmeans(aligned, radii, method)
 
-        # sort df based on new labels
-        df = df.sort_values(['fragment_id', 'kmeans_label'])
+        # the saved distribution belongs to the model that is used
+        distribution = calc_avg_rmse(fragment, aligned, avg_frag_settings)
 
-        fragment = average_fragment(df, avg_frag_settings, radii)
-
-        rmse_avg = calc_avg_rmse(fragment, avg_frag_settings, df)
+        if distribution['mean'] > RMSE_TEST:
+            print("RMSEs are still too high after resetting the labels")
 
     if avg_frag_settings.central_name in list(pd.read_csv(avg_frag_settings.get_methyl_csv_filename(),
                                               header=0, comment="#").central):
@@ -72,78 +74,96 @@ def calc_avg_frag(df, avg_frag_settings, radii):
     return fragment
 
 
-def reset_labels_with_kmeans(df, avg_frag_settings):
-    # only keep central group
-    df = df[df.label != "-"].copy().reset_index()
+def relabel_with_kmeans(aligned, radii, method="mean", chunk_size=CHUNK_SIZE):
+    """ Gives the central atoms new labels with KMeans, without loading all central groups at once. The centres are
+        fitted on one mini-batch of fragments at a time, starting from the first fragment. Then every atom gets the
+        label of its nearest centre, chunk by chunk, and the average fragment is the average of each label with the
+        method of average_fragment. """
 
-    first_frag = df[df.fragment_id == 0]
-    no_atoms_central = len(first_frag)
+    atoms = aligned.get_atom_indices("central")
+    first_frag = aligned.coordinates[0, atoms]
+    no_atoms_central = len(atoms)
 
-    first_frag = np.array([np.array(first_frag.x), np.array(first_frag.y), np.array(first_frag.z)]).T
-    data = np.array([np.array(df.x), np.array(df.y), np.array(df.z)]).T
+    kmeans = MiniBatchKMeans(n_clusters=no_atoms_central, init=first_frag, n_init=1, batch_size=chunk_size)
 
-    # initialize kmeans
-    kmeans = KMeans(n_clusters=no_atoms_central, init=first_frag, n_init=1)
+    for start in range(0, aligned.no_fragments, chunk_size):
+        kmeans.partial_fit(aligned.coordinates[start:start + chunk_size, atoms].reshape(-1, 3))
 
-    kmeans.fit(data)
-    labels = kmeans.labels_
+    centres = kmeans.cluster_centers_
 
-    df['kmeans_label'] = [str(label) for label in labels]
+    sums, counts = np.zeros((no_atoms_central, 3)), np.zeros(no_atoms_central)
+    squared_error = 0
 
-    return df
+    # the median and the trimmed mean are not taken chunk by chunk, so the label of every atom is kept for them
+    labels = np.empty(aligned.no_fragments * no_atoms_central, dtype=np.int64) if method != "mean" else None
 
+    for start in range(0, aligned.no_fragments, chunk_size):
+        points = aligned.coordinates[start:start + chunk_size, atoms].reshape(-1, 3)
+        nearest, squared_distances = assign_nearest_centres(points, centres)
 
-def calc_kabsch_rmse(settings):
-    structures_file = settings.get_structure_csv_filename()
+        if labels is not None:
+            labels[start * no_atoms_central:start * no_atoms_central + len(nearest)] = nearest
 
-    first_rmse = pd.read_csv(structures_file).rmse.mean()
-    print(f"Average RMSE kabsch alignment: {first_rmse :.2f}")
+        sums += np.stack([np.bincount(nearest, weights=points[:, i], minlength=no_atoms_central) for i in range(3)],
+                         axis=1)
+        counts += np.bincount(nearest, minlength=no_atoms_central)
+        squared_error += np.sum(squared_distances)
 
-    return first_rmse
+    print(f"Average RMSE KMeans centres: {np.sqrt(squared_error / len(atoms) / aligned.no_fragments) :.2f}")
 
+    # every label keeps the atom of the first fragment it was started from
+    fragment = pd.DataFrame({'label': aligned.labels[atoms],
+                             'symbol': aligned.symbols[aligned.symbol_codes[0, atoms]]})
+    fragment[['x', 'y', 'z']] = sums / np.maximum(counts, 1)[:, np.newaxis]
 
-def get_aligned_fragments_for_rmse(settings):
-    frags_file = settings.get_aligned_csv_filename()
+    if labels is not None:
+        points = aligned.coordinates[:, atoms].reshape(-1, 3)
 
-    # this is the old number of atoms
-    rows = 5000
+        for label in np.flatnonzero(counts):
+            fragment.loc[label, ['x', 'y', 'z']] = calc_average(points[labels == label], method)
 
-    df = pd.read_csv(frags_file, nrows=rows)
+    return add_radii(fragment, count_R_elements(aligned), radii)
 
-    # correct for atoms that are thrown away after reading
-    no_atoms = len(df[df.fragment_id == 0])
-    rows = 100 * no_atoms
-    df = pd.read_csv(frags_file, nrows=rows)
 
-    return df
+def calc_kabsch_rmse(settings):
+    structures_file = settings.get_structure_csv_filename()
+
+    first_rmse = pd.read_csv(structures_file).rmse.mean()
+    print(f"Average RMSE kabsch alignment: {first_rmse :.2f}")
+
+    return first_rmse
 
 
-def calc_avg_rmse(avg_fragment, settings, df=None):
+def calc_avg_rmse(avg_fragment, aligned, settings, no_bins=50):
+    """ Calculates the rmse of every fragment in the store to the average fragment, chunk by chunk, and saves their
+        distribution: the mean, some quantiles and a histogram. Returns the distribution. """
 
-    if df is None:
-        df = get_aligned_fragments_for_rmse(settings)
+    atoms = aligned.get_atom_indices("central")
 
-    no_atoms_central = len(df[(df.fragment_id == 0) & (df.label != "-")])
+    # matrix A is avg fragment, without the atoms of a model methyl group
+    A = avg_fragment[['x', 'y', 'z']].to_numpy()[:len(atoms)]
 
-    unique_frags = df.fragment_id.unique()
+    rmses = np.empty(aligned.no_fragments)
+    for start in range(0, aligned.no_fragments, CHUNK_SIZE):
+        rmses[start:start + CHUNK_SIZE] = calc_rmse(A, aligned.coordinates[start:start + CHUNK_SIZE, atoms], len(atoms))
 
-    # matrix A is avg fragment
-    avg_fragment = avg_fragment[:no_atoms_central]
-    A = np.array([np.array(avg_fragment.x), np.array(avg_fragment.y), np.array(avg_fragment.z)]).T
-    n = A.shape[0]
+    quantiles = [0.05, 0.25, 0.5, 0.75, 0.95, 0.99]
+    counts, edges = np.histogram(rmses, bins=no_bins)
 
-    rmse_list = []
-    # matrix B is first 100 fragments
-    for unique_frag in unique_frags[:100]:
-        frag = df[df.fragment_id == unique_frag][:no_atoms_central]
-        B = np.array([np.array(frag.x), np.array(frag.y), np.array(frag.z)]).T
+    distribution = {'no_fragments': len(rmses),
+                    'mean': float(np.mean(rmses)),
+                    'std': float(np.std(rmses)),
+                    'max': float(np.max(rmses)),
+                    'quantiles': dict(zip(map(str, quantiles), np.quantile(rmses, quantiles).tolist())),
+                    'histogram': {'counts': counts.tolist(), 'edges': edges.tolist()}}
 
-        rmse_list.append(calc_rmse(A, B, n))
+    with open(settings.get_avg_frag_rmse_filename(), 'w') as outputfile:
+        json.dump(distribution, outputfile)
 
-    avg_rmse = np.mean(rmse_list)
-    print(f"Average RMSE average fragment: {avg_rmse :.2f}")
+    print(f"Average RMSE average fragment: {distribution['mean'] :.2f} "
+          f"(median {distribution['quantiles']['0.5'] :.2f}, 95% below {distribution['quantiles']['0.95'] :.2f})")
 
-    return avg_rmse
+    return distribution
 
 
 if __name__ == "__main__":
@@ -15,9 +15,10 @@ import time
 import numpy as np
 import pandas as pd
 
+from classes.AlignedFragments import AlignedFragments
 from classes.Settings import Settings
 from classes.Radii import Radii
-from helpers.density_helpers import make_density_df, find_available_volume, calc_distances
+from helpers.density_helpers import make_density_df, find_available_volume, calc_distances, get_bin_centers
 from helpers.geometry_helpers import make_coordinate_df
 
 from constants.constants import STANDARD_THRESHOLD, STANDARD_RES, STANDARD_EXTRA_VDW
@@ -40,7 +41,7 @@ def main():
     settings.set_threshold(STANDARD_THRESHOLD)
 
     try:
-        df = pd.read_csv(settings.get_aligned_csv_filename(), header=0)
+        aligned = AlignedFragments(settings).open()
         avg_frag = pd.read_csv(settings.outputfile_prefix + "_avg_fragment.csv", header=0)
     except FileNotFoundError:
         print('First align and calculate average fragment.')
@@ -49,7 +50,7 @@ def main():
     radii = Radii(settings.get_radii_csv_name())
 
     # grab only the atoms that are in the contact groups
-    coordinate_df = make_coordinate_df(df, settings, avg_frag, radii)
+    coordinate_df = make_coordinate_df(aligned, settings, avg_frag, radii)
 
     density_df = make_density_df(settings, coordinate_df, again=True)
 
@@ -79,12 +80,7 @@ def main():
 
 def calc_vdw_overlap(in_cluster, settings, avg_fragment, contact_group_radius):
 
-    # center of bin is at xstart + a half times the resolution
-    in_cluster['x_center'] = in_cluster.xstart + 0.5 * settings.resolution
-    in_cluster['y_center'] = in_cluster.ystart + 0.5 * settings.resolution
-    in_cluster['z_center'] = in_cluster.zstart + 0.5 * settings.resolution
-
-    bin_coordinates = np.transpose(np.array([in_cluster.x_center, in_cluster.y_center, in_cluster.z_center]))
+    bin_coordinates = get_bin_centers(in_cluster, settings.resolution)
     in_vdw_vol = np.zeros(len(in_cluster))
 
     for i, atom in avg_fragment.iterrows():
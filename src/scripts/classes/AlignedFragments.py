@@ -0,0 +1,149 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# This script is part of the quantification pipeline of 3D experimental data of crystal structures that I wrote for my
+# thesis in the Master Computational Science, University of Amsterdam, 2021.
+#
+# `AlignedFragments` is a class that stores the coordinates of the aligned fragments as a memory mapped array of
+# shape (fragments, atoms, 3), with a sidecar file that contains the labels and the symbols. This way only the central
+# atoms or only the contact atoms can be read, without loading all data.
+#
+# Author: Natasja Wezel
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from helpers.general_helpers import to_codes, write_array
+
+
+class AlignedFragments():
+    """ Store of the aligned fragments. The arrays are written chunk by chunk during the alignment, and the sidecar is
+        only written when the alignment is done, so an interrupted alignment is never used. """
+
+    def __init__(self, settings):
+        self.sidecar_file = settings.get_aligned_filename()
+        self.coordinates_file = settings.get_aligned_array_filename("coordinates")
+        self.symbols_file = settings.get_aligned_array_filename("symbols")
+        self.ids_file = settings.get_aligned_array_filename("ids")
+
+        self.sidecar = None
+
+    def exists(self):
+        return os.path.exists(self.sidecar_file)
+
+    def start_writing(self, labels, no_atoms_central, options=None):
+        """ Removes the results of an earlier alignment and prepares the categories of symbols and atom ids. The options
+            of the alignment are saved in the sidecar. """
+
+        if self.exists():
+            os.remove(self.sidecar_file)
+
+        for filename in [self.coordinates_file, self.symbols_file, self.ids_file]:
+            open(filename, 'wb').close()
+
+        self.sidecar = {'no_fragments': 0, 'no_removed': 0, 'no_atoms': len(labels),
+                        'no_atoms_central': no_atoms_central, 'labels': list(labels), 'symbols': [], 'ids': [],
+                        'options': options}
+        self.symbol_categories, self.id_categories = {}, {}
+
+    def append(self, coordinates, atom_ids, symbols):
+        """ Appends a chunk of aligned fragments with shape (fragments, atoms, 3) to the store. """
+
+        write_array(self.coordinates_file, coordinates.astype(np.float64))
+        write_array(self.symbols_file, to_codes(symbols, self.symbol_categories, np.uint8))
+        write_array(self.ids_file, to_codes(atom_ids, self.id_categories, np.int32))
+
+        self.sidecar['no_fragments'] += len(coordinates)
+
+    def add_removed(self, no_removed):
+        """ Counts the fragments that were left out of the store. """
+
+        self.sidecar['no_removed'] += int(no_removed)
+
+    def close(self):
+        """ Writes the sidecar, which makes the store complete. """
+
+        self.sidecar['symbols'] = list(self.symbol_categories.keys())
+        self.sidecar['ids'] = list(self.id_categories.keys())
+
+        # written under another name first, so a half written sidecar is never used
+        with open(self.sidecar_file + ".tmp", 'w') as outputfile:
+            json.dump(self.sidecar, outputfile)
+
+        os.replace(self.sidecar_file + ".tmp", self.sidecar_file)
+
+    def read_sidecar(self):
+        """ Reads the sidecar only, without mapping the arrays. """
+
+        with open(self.sidecar_file) as inputfile:
+            self.sidecar = json.load(inputfile)
+
+        return self
+
+    def open(self, mode='r'):
+        """ Reads the sidecar and maps the arrays into memory, without reading them. With mode 'r+' the coordinates can
+            be changed in place. """
+
+        self.read_sidecar()
+
+        shape = (self.no_fragments, self.no_atoms)
+
+        self.coordinates = np.memmap(self.coordinates_file, dtype=np.float64, mode=mode, shape=shape + (3,))
+        self.symbol_codes = np.memmap(self.symbols_file, dtype=np.uint8, mode='r', shape=shape)
+        self.id_codes = np.memmap(self.ids_file, dtype=np.int32, mode='r', shape=shape)
+
+        self.labels = np.array(self.sidecar['labels'], dtype=object)
+        self.symbols = np.array(self.sidecar['symbols'], dtype=object)
+        self.ids = np.array(self.sidecar['ids'], dtype=object)
+
+        return self
+
+    @property
+    def no_fragments(self):
+        return self.sidecar['no_fragments']
+
+    @property
+    def no_removed(self):
+        return self.sidecar.get('no_removed', 0)
+
+    @property
+    def options(self):
+        return self.sidecar.get('options')
+
+    @property
+    def no_atoms(self):
+        return self.sidecar['no_atoms']
+
+    @property
+    def no_atoms_central(self):
+        return self.sidecar['no_atoms_central']
+
+    def get_atom_indices(self, part=None):
+        """ Returns the indices of the atoms in a fragment that belong to the central group ('central'), the contact
+            group ('contact') or of all atoms. """
+
+        if part == "central":
+            return np.flatnonzero(self.labels != "-")
+        elif part == "contact":
+            return np.flatnonzero(self.labels == "-")
+
+        return np.arange(self.no_atoms)
+
+    def to_dataframe(self, part=None, fragments=slice(None)):
+        """ Makes a dataframe like the old aligned csv file, but only for the atoms of the given part and the given
+            slice of fragments. """
+
+        atoms = self.get_atom_indices(part)
+        fragment_ids = np.arange(self.no_fragments)[fragments]
+
+        coordinates = self.coordinates[fragments][:, atoms].reshape(-1, 3)
+
+        return pd.DataFrame({'fragment_id': np.repeat(fragment_ids, len(atoms)),
+                             '_id': self.ids[self.id_codes[fragments][:, atoms].ravel()],
+                             'symbol': self.symbols[self.symbol_codes[fragments][:, atoms].ravel()],
+                             'label': np.tile(self.labels[atoms], len(fragment_ids)),
+                             'x': coordinates[:, 0],
+                             'y': coordinates[:, 1],
+                             'z': coordinates[:, 2]})
@@ -0,0 +1,92 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# This script is part of the quantification pipeline of 3D experimental data of crystal structures that I wrote for my
+# thesis in the Master Computational Science, University of Amsterdam, 2021.
+#
+# `AlignmentPool` is a class that divides the alignment of a stack of fragments over a pool of processes. The
+# coordinates are put in shared memory, and every worker aligns its own shard of fragments in place.
+#
+# Author: Natasja Wezel
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context, shared_memory
+
+import numpy as np
+
+from numba import set_num_threads
+
+from helpers.alignment_helpers import align_fragments
+
+
+class AlignmentPool():
+    """ Pool of worker processes with a shared coordinate buffer. The fragments are aligned independently of each other,
+        so the results are the same as those of aligning all fragments in one process. """
+
+    def __init__(self, workers):
+        self.workers = workers
+        # spawn new processes instead of forking, forking a process that already runs numba threads can deadlock
+        self.executor = ProcessPoolExecutor(max_workers=workers, mp_context=get_context("spawn"),
+                                            initializer=set_num_threads, initargs=(1,))
+        self.memory = None
+
+    def align(self, A, fragments, no_atoms_central, to_mirror, engine="numpy"):
+        """ Aligns a stack of fragments with shape (fragments, atoms, 3) onto central group A in place. Returns which
+            fragments are mirrored and the rmse of each fragment, like align_fragments. """
+
+        if len(fragments) == 0:
+            return np.zeros(0, dtype=bool), np.zeros(0)
+
+        self.make_buffer(fragments.nbytes)
+
+        shared = np.ndarray(fragments.shape, dtype=np.float64, buffer=self.memory.buf)
+        shared[:] = fragments
+
+        # divide the fragments in one shard per worker
+        bounds = np.linspace(0, len(fragments), self.workers + 1).astype(int)
+        shards = [slice(start, stop) for start, stop in zip(bounds[:-1], bounds[1:]) if stop > start]
+
+        results = list(self.executor.map(align_shard, [self.memory.name] * len(shards),
+                                         [fragments.shape] * len(shards), shards, [A] * len(shards),
+                                         [no_atoms_central] * len(shards), [to_mirror] * len(shards),
+                                         [engine] * len(shards)))
+
+        fragments[:] = shared
+        del shared
+
+        mirrored = np.concatenate([result[0] for result in results])
+        rmses = np.concatenate([result[1] for result in results])
+
+        return mirrored, rmses
+
+    def make_buffer(self, size):
+        """ Makes sure the shared buffer is big enough, it is only made again if the chunks of fragments grow. """
+
+        if self.memory is not None and self.memory.size >= size:
+            return
+
+        self.close_buffer()
+        self.memory = shared_memory.SharedMemory(create=True, size=size)
+
+    def close_buffer(self):
+        if self.memory is not None:
+            self.memory.close()
+            self.memory.unlink()
+            self.memory = None
+
+    def close(self):
+        self.executor.shutdown()
+        self.close_buffer()
+
+
+def align_shard(name, shape, shard, A, no_atoms_central, to_mirror, engine):
+    """ Aligns one shard of the fragments in the shared buffer in place. """
+
+    memory = shared_memory.SharedMemory(name=name)
+
+    fragments = np.ndarray(shape, dtype=np.float64, buffer=memory.buf)
+    mirrored, rmses = align_fragments(A, fragments[shard], no_atoms_central, to_mirror, engine)
+
+    del fragments
+    memory.close()
+
+    return mirrored, rmses
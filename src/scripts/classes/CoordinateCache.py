@@ -0,0 +1,181 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# This script is part of the quantification pipeline of 3D experimental data of crystal structures that I wrote for my
+# thesis in the Master Computational Science, University of Amsterdam, 2021.
+#
+# `CoordinateCache` is a class that saves the parsed contents of a coordinate file from conquest in a binary folder next
+# to that file. The coordinates are saved as float32, the atom ids and structure ids as categories. The next time the
+# same file is read, the arrays are loaded from the cache instead of parsing the text again.
+#
+# Author: Natasja Wezel
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+import hashlib
+import json
+import os
+import shutil
+
+import numpy as np
+
+from helpers.general_helpers import to_codes, write_array
+
+
+class CoordinateCache():
+    """ Cache of a parsed coordinate file. It is valid if the size and modification time of the file did not change,
+        or, if only the modification time changed, if the hash of the contents is still the same. """
+
+    def __init__(self, coordinate_file, no_atoms):
+        self.coordinate_file = coordinate_file
+        self.no_atoms = no_atoms
+
+        self.folder = coordinate_file.rsplit('.', 1)[0] + "_cache"
+        self.key_file = os.path.join(self.folder, "key.json")
+
+        # categories of the atom and structure ids, and the amount of fragments added while writing
+        self.atom_ids = {}
+        self.structure_ids = {}
+        self.no_fragments = 0
+        self.decimals = None
+        self.writable = True
+
+    def is_valid(self):
+        """ Checks if the cache belongs to the current contents of the coordinate file. """
+
+        try:
+            with open(self.key_file) as inputfile:
+                key = json.load(inputfile)
+        except (FileNotFoundError, ValueError):
+            return False
+
+        stat = os.stat(self.coordinate_file)
+
+        if key['size'] != stat.st_size or key['no_atoms'] != self.no_atoms:
+            return False
+
+        if key['mtime'] != stat.st_mtime_ns:
+            # the file was touched or copied, so only trust the cache if the contents are the same
+            if key['hash'] != hash_file(self.coordinate_file):
+                return False
+
+            key['mtime'] = stat.st_mtime_ns
+
+            try:
+                self.write_key(key)
+            except OSError:
+                pass
+
+        return True
+
+    def load(self, start=0, stop=None):
+        """ Loads the coordinates, atom ids and structure ids of the fragments from start until stop. The coordinate
+            files only contain a fixed amount of decimals, so rounding restores the exact values from the text. """
+
+        with open(self.key_file) as inputfile:
+            key = json.load(inputfile)
+
+        no_fragments = key['no_fragments']
+        stop = no_fragments if stop is None else min(stop, no_fragments)
+
+        coordinates = self.open_array("coordinates", np.float32, (no_fragments, self.no_atoms, 3))
+        atom_id_codes = self.open_array("atom_id_codes", np.int32, (no_fragments, self.no_atoms))
+        structure_id_codes = self.open_array("structure_id_codes", np.int32, (no_fragments,))
+
+        atom_ids = np.array(key['atom_ids'], dtype=object)
+        structure_ids = np.array(key['structure_ids'], dtype=object)
+
+        return (np.round(coordinates[start:stop].astype(float), key['decimals']),
+                atom_ids[atom_id_codes[start:stop]],
+                structure_ids[structure_id_codes[start:stop]])
+
+    def iter_chunks(self, chunk_size):
+        """ Generator that yields the cached fragments in chunks, like when they are read from the text file. """
+
+        with open(self.key_file) as inputfile:
+            no_fragments = json.load(inputfile)['no_fragments']
+
+        for start in range(0, no_fragments, chunk_size):
+            yield self.load(start, start + chunk_size)
+
+    def get_array_filename(self, name):
+        return os.path.join(self.folder, name + ".bin")
+
+    def open_array(self, name, dtype, shape):
+        return np.memmap(self.get_array_filename(name), dtype=dtype, mode='r', shape=shape)
+
+    def append(self, coordinates, atom_ids, structure_ids):
+        """ Appends a chunk of parsed fragments to the cache. If something goes wrong, the cache is not written. """
+
+        if not self.writable:
+            return
+
+        try:
+            if self.no_fragments == 0:
+                self.start_writing()
+
+            coordinates_32 = coordinates.astype(np.float32)
+
+            # float32 is only precise enough for the coordinates if they are not too far from the origin
+            if not np.array_equal(np.round(coordinates_32.astype(float), self.decimals), coordinates):
+                print("Coordinates are too large to cache as float32, not caching the coordinate file")
+                self.writable = False
+                return
+
+            write_array(self.get_array_filename("coordinates"), coordinates_32)
+            write_array(self.get_array_filename("atom_id_codes"), to_codes(atom_ids, self.atom_ids, np.int32))
+            write_array(self.get_array_filename("structure_id_codes"),
+                        to_codes(structure_ids, self.structure_ids, np.int32))
+
+            self.no_fragments += len(structure_ids)
+        except OSError as exception:
+            print(f"Could not write cache of coordinate file: {exception}")
+            self.writable = False
+
+    def start_writing(self):
+        """ Removes an old cache and finds out how many decimals the coordinates in the file have. """
+
+        if os.path.exists(self.folder):
+            shutil.rmtree(self.folder)
+        os.mkdir(self.folder)
+
+        with open(self.coordinate_file) as inputfile:
+            next(inputfile)
+            x = next(inputfile).split()[1]
+
+        self.decimals = len(x.split('.')[1]) if '.' in x else 0
+
+    def close(self):
+        """ Writes the key of the cache. Only then the cache is complete and can be used. """
+
+        if not self.writable or self.no_fragments == 0:
+            return
+
+        stat = os.stat(self.coordinate_file)
+
+        key = {'size': stat.st_size,
+               'mtime': stat.st_mtime_ns,
+               'hash': hash_file(self.coordinate_file),
+               'no_atoms': self.no_atoms,
+               'no_fragments': self.no_fragments,
+               'decimals': self.decimals,
+               'atom_ids': list(self.atom_ids.keys()),
+               'structure_ids': list(self.structure_ids.keys())}
+
+        try:
+            self.write_key(key)
+        except OSError as exception:
+            print(f"Could not write cache of coordinate file: {exception}")
+
+    def write_key(self, key):
+        with open(self.key_file, 'w') as outputfile:
+            json.dump(key, outputfile)
+
+
+def hash_file(filename, blocksize=2**20):
+    """ Calculates the sha1 hash of the contents of a file. """
+
+    sha1 = hashlib.sha1()
+
+    with open(filename, 'rb') as inputfile:
+        for block in iter(lambda: inputfile.read(blocksize), b''):
+            sha1.update(block)
+
+    return sha1.hexdigest()
@@ -0,0 +1,116 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# This script is part of the quantification pipeline of 3D experimental data of crystal structures that I wrote for my
+# thesis in the Master Computational Science, University of Amsterdam, 2021.
+#
+# `DensityStore` is a class that stores the bins that contain contact points in a memory mapped file, as rows with the
+# integer coordinates of the bin and the amount of points, one block of rows per resolution. A sidecar file contains
+# the resolution, the bounding box and the contact reference point of each block. A block is only read when it is used.
+#
+# Author: Natasja Wezel
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+import json
+import os
+
+import numpy as np
+import pandas as pd
+
+from helpers.general_helpers import write_array
+
+
+class DensityStore():
+    """ Store of the density of one contact reference point, at one resolution or at all resolutions of the pyramid.
+        Only the bins with datapoints are stored, so the size does not depend on the box around the datapoints. The
+        center of a bin is at its coordinates times the resolution. The sidecar is written last, so an interrupted
+        write is never used. """
+
+    dtype = np.int32
+
+    def __init__(self, settings, pyramid=False):
+        name = settings.get_density_name(pyramid)
+
+        self.sidecar_file = name + ".json"
+        self.bins_file = name + ".bin"
+        self.contact_rp = settings.contact_rp
+
+        self.sidecar = None
+
+    def exists(self):
+        return os.path.exists(self.sidecar_file)
+
+    def write(self, levels):
+        """ Writes the occupied bins of each level, given as (resolution, bins, counts) with the integer coordinates of
+            the bins in an array of shape (bins, 3), after each other. """
+
+        if self.exists():
+            os.remove(self.sidecar_file)
+
+        open(self.bins_file, 'wb').close()
+
+        self.sidecar = {'contact_rp': self.contact_rp, 'dtype': np.dtype(self.dtype).name, 'levels': []}
+        offset = 0
+
+        for resolution, bins, counts in levels:
+            write_array(self.bins_file, np.column_stack([bins, counts]).astype(self.dtype))
+
+            # the bounding box of the occupied bins
+            first_bin, last_bin = bins.min(axis=0), bins.max(axis=0)
+
+            self.sidecar['levels'].append({'resolution': float(resolution),
+                                           'first_bin': [int(coordinate) for coordinate in first_bin],
+                                           'origin': [float(coordinate * resolution) for coordinate in first_bin],
+                                           'shape': [int(size) for size in last_bin - first_bin + 1],
+                                           'offset': offset,
+                                           'no_bins': len(bins),
+                                           'no_points': int(counts.sum())})
+            offset += len(bins)
+
+        with open(self.sidecar_file, 'w') as outputfile:
+            json.dump(self.sidecar, outputfile)
+
+        return self
+
+    def open(self):
+        """ Reads the sidecar and maps the bins into memory, without reading them. """
+
+        with open(self.sidecar_file) as inputfile:
+            self.sidecar = json.load(inputfile)
+
+        no_rows = sum(level['no_bins'] for level in self.sidecar['levels'])
+
+        self.bins = np.memmap(self.bins_file, dtype=self.sidecar['dtype'], mode='r', shape=(no_rows, 4))
+
+        return self
+
+    @property
+    def resolutions(self):
+        return [level['resolution'] for level in self.sidecar['levels']]
+
+    def get_level(self, resolution):
+        """ Returns the metadata of the bins of a resolution. """
+
+        for level in self.sidecar['levels']:
+            if round(level['resolution'], 2) == round(resolution, 2):
+                return level
+
+        raise KeyError(f"Resolution {resolution} is not in the density store of {self.contact_rp}")
+
+    def get_bins(self, resolution):
+        """ Returns the occupied bins of a resolution as a view on the memory mapped file, with a row (xbin, ybin, zbin,
+            amount) per bin. """
+
+        level = self.get_level(resolution)
+
+        return self.bins[level['offset']:level['offset'] + level['no_bins']]
+
+    def to_dataframe(self, resolution):
+        """ Makes a density df of the bins that contain datapoints, with the integer coordinates of the bins, the amount
+            of datapoints and the fraction of all datapoints. """
+
+        bins = np.array(self.get_bins(resolution))
+
+        df = pd.DataFrame({column: bins[:, axis] for axis, column in enumerate(['xbin', 'ybin', 'zbin'])})
+        df[self.contact_rp] = bins[:, 3].astype(float)
+        df['datafrac_normalized'] = df[self.contact_rp] / df[self.contact_rp].sum()
+
+        return df
@@ -69,6 +69,16 @@ class Fingerprint():
 
         return self.specific.iloc[self.counter].description
 
+    def get_masks(self, model_labels):
+        """ Returns for the closest atom plot and for every plot in the csv which atoms of the model are used, as a
+            boolean array with shape (plots, atoms). """
+
+        masks = [np.ones(len(model_labels), dtype=bool)]
+        for labels in self.specific.labels:
+            masks.append(np.isin(model_labels, labels.split('&')))
+
+        return np.array(masks)
+
     def not_done(self):
         """ A boolean to see if all plots are made or not. """
 
@@ -79,23 +89,24 @@ class Fingerprint():
 
         self.counter += 1
 
-    def make_plot(self, coordinate_df, STANDARD_EXTRA_VDW):
-        """ Makes the plots. Takes as input the coordinate df with the vdw corrected distance already calculated. """
+    def make_plot(self, moved, max_vdw, STANDARD_EXTRA_VDW):
+        """ Makes the plots. Takes as input the vdw corrected distances of the contact points, and the largest vdw
+            radius of the closest atoms. """
 
         fig = plt.figure(figsize=(8, 4))
         fig.subplots_adjust(bottom=0.3)
         plt.title(f"Fingerprint of {self.central} ({self.get_description()})--{self.contact} ({self.contact_rp})")
 
-        # get two dataframes: one containing the points with vdw overlap and one without
-        test_neg = coordinate_df[coordinate_df["moved"] < 0]
-        test_pos = coordinate_df[coordinate_df["moved"] >= 0]
+        # split the points with vdw overlap from the points without
+        negative = moved[moved < 0]
+        positive = moved[moved >= 0]
 
         # write down information in the plot
-        plt.figtext(0.15, 0.11, f"Negative fraction: {len(test_neg)/len(coordinate_df) * 100 :.2f}%,\
-                    Mean: {test_neg['moved'].mean() :.2f}$\\AA$")
-        plt.figtext(0.15, 0.06, f"Positive fraction: {len(test_pos)/len(coordinate_df) * 100 :.2f}%,\
-                    Mean: {test_pos['moved'].mean() :.2f}$\\AA$")
-        plt.figtext(0.15, 0.01, f"Overall mean: {coordinate_df['moved'].mean() :.2f}$\\AA$")
+        plt.figtext(0.15, 0.11, f"Negative fraction: {len(negative)/len(moved) * 100 :.2f}%,\
+                    Mean: {negative.mean() :.2f}$\\AA$")
+        plt.figtext(0.15, 0.06, f"Positive fraction: {len(positive)/len(moved) * 100 :.2f}%,\
+                    Mean: {positive.mean() :.2f}$\\AA$")
+        plt.figtext(0.15, 0.01, f"Overall mean: {moved.mean() :.2f}$\\AA$")
 
         plt.xlabel("VDW overlap ($\\AA$)")
         plt.ylabel("Percentage of total data points")
@@ -107,13 +118,13 @@ class Fingerprint():
 
         # give the lines for vdw corrected distance, 0 and the maximum distance
         plt.vlines(0, 0, 0.15, color="black", label="VDW radius atom central")
-        plt.vlines(coordinate_df['vdw_closest_atom'].max(), 0, 0.15, color="lightgreen", label="VDW radii")
-        plt.vlines(coordinate_df['vdw_closest_atom'].max() + STANDARD_EXTRA_VDW, 0, 0.15,
+        plt.vlines(max_vdw, 0, 0.15, color="lightgreen", label="VDW radii")
+        plt.vlines(max_vdw + STANDARD_EXTRA_VDW, 0, 0.15,
                    color="green",
                    label="VDW radii + " + str(STANDARD_EXTRA_VDW))
 
         # calculate and normalize the heights of the bins
-        heights, bins = np.histogram(coordinate_df.moved, bins='auto')
+        heights, bins = np.histogram(moved, bins='auto')
         heights = (heights/sum(heights) * 100)
 
         plt.bar(bins[:-1], heights, width=(max(bins) - min(bins))/len(bins)+0.01)
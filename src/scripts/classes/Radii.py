@@ -3,54 +3,59 @@
 # thesis in the Master Computational Science, University of Amsterdam, 2021.
 #
 # `Radii` is a class that takes as input the Radii csv, and is used to get the covalent and vanderwaals radii of
-# elements. They are saved in a dictionary, so that if the same element is looked up again, we do not need to open the
-# file and read it again.
+# elements. The csv is only read once per process, into arrays indexed by symbol, so the radii of many atoms can be
+# looked up at once.
 #
 # Author: Natasja Wezel
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
+import numpy as np
 import pandas as pd
 
 
 class Radii():
+    """ All Radii objects of the same csv share one table, which is read the first time the csv is used. """
+
+    tables = {}
+
     def __init__(self, RADII_CSV):
         self.radii_filename = RADII_CSV
-        self.vdw_radii = {}
-        self.cov_radii = {}
 
-    def get_vdw_radius(self, symbol):
-        """ Adds element with vdw radius to dictionary if not exists yet, and returns its vdw radius. """
+        if RADII_CSV not in Radii.tables:
+            radii_df = pd.read_csv(RADII_CSV, comment="#")
 
-        # if not looked up before
-        if symbol not in self.vdw_radii.keys():
+            assert radii_df.symbol.is_unique, "Every element can only be once in the radii csv."
 
-            # read file, find and add vdw_radius to dictionary
-            radii_df = pd.read_csv(self.radii_filename, comment="#")
-            test_df = radii_df[radii_df.symbol == symbol]
+            Radii.tables[RADII_CSV] = {'symbols': pd.Index(radii_df.symbol),
+                                       'vdw': radii_df.vdw_radius.to_numpy(dtype=float),
+                                       'cov': radii_df.cov_radius.to_numpy(dtype=float)}
 
-            assert len(test_df) == 1, "You're trying to look up vdw radius of element that is not in bondi's list."
+        self.table = Radii.tables[RADII_CSV]
 
-            self.vdw_radii[symbol] = float(test_df.vdw_radius)
+    def lookup(self, symbols, radius="vdw"):
+        """ Returns an array with the vdw or cov radius of every symbol in an array of symbols. Every unique symbol is
+            only looked up once. """
 
-        # return dictionary value
-        return self.vdw_radii[symbol]
+        assert radius in ["vdw", "cov"], "Radius must be either vdw or cov."
 
-    def get_cov_radius(self, symbol):
-        """ Adds element with cov radius to dictionary if not exist yet, and returns its covalent radius. """
+        symbols = np.asarray(symbols, dtype=object)
 
-        # if not looked up before
-        if symbol not in self.cov_radii.keys():
+        codes, unique_symbols = pd.factorize(symbols.ravel())
+        indices = self.table['symbols'].get_indexer(unique_symbols)
 
-            # read file, find and add cov_radius to dictionary
-            radii_df = pd.read_csv(self.radii_filename, comment="#")
-            test_df = radii_df[radii_df.symbol == symbol]
+        assert np.all(indices >= 0), "You're trying to look up the radius of an element that is not in bondi's list."
 
-            assert len(test_df) == 1, "You're trying to look up cov radius of element that is not in bondi's list."
+        return self.table[radius][indices][codes].reshape(symbols.shape)
 
-            self.cov_radii[symbol] = float(test_df.cov_radius)
+    def get_vdw_radius(self, symbol):
+        """ Returns the vdw radius of one element. """
+
+        return float(self.lookup([symbol], "vdw")[0])
+
+    def get_cov_radius(self, symbol):
+        """ Returns the covalent radius of one element. """
 
-        # return dictionary value
-        return self.cov_radii[symbol]
+        return float(self.lookup([symbol], "cov")[0])
 
     def get_vdw_distance_contact(self, contact_rp):
         """ Returns the vanderwaals radius from the atom that is the reference point of the contact group. If the rp is
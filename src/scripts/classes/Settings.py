@@ -72,8 +72,11 @@ class Settings():
     def set_threshold(self, threshold):
         self.threshold = round(threshold, 2)
 
-    def get_aligned_csv_filename(self):
-        return self.outputfile_prefix + "_aligned.csv"
+    def get_aligned_filename(self):
+        return self.outputfile_prefix + "_aligned.json"
+
+    def get_aligned_array_filename(self, name):
+        return self.outputfile_prefix + "_aligned_" + name + ".bin"
 
     def get_structure_csv_filename(self):
         return self.outputfile_prefix + "_structures.csv"
@@ -105,11 +108,9 @@ class Settings():
     def get_coordinate_df_key(self):
         return self.contact_rp
 
-    def get_density_df_filename(self):
-        return self.outputfile_prefix + "_density.hdf"
-
-    def get_density_df_key(self):
-        return self.contact_rp + str(self.resolution).rstrip("0").replace(".", "")
+    def get_density_name(self, pyramid=False):
+        level = "pyramid" if pyramid else f"{self.resolution:.2f}"
+        return self.outputfile_prefix + "_density_" + self.contact_rp + "_" + level
 
     def get_density_plotname(self):
         return self.outputfile_prefix + "_" + str(self.resolution) + "_density.svg"
@@ -118,6 +119,9 @@ class Settings():
         avg_fragment_filename = self.outputfile_prefix + "_avg_fragment.csv"
         return avg_fragment_filename
 
+    def get_avg_frag_rmse_filename(self):
+        return self.outputfile_prefix + "_avg_fragment_rmse.json"
+
 
 class AlignmentSettings(Settings):
     """ Alignment Settings contains some extra parameters for superimposition, and inherits all functionality from its
@@ -142,17 +146,6 @@ class AlignmentSettings(Settings):
     def get_no_fragments(self):
         return self.no_fragments
 
-    def get_aligned_csv_filenames(self):
-        return self.get_aligned_csv_filename(), self.get_structure_csv_filename()
-
-    def update_coordinate_filename(self):
-        # TODO: fix dit met multiple files and original file too big enzo
-        if self.central_name == "RC6H5" and (self.contact_name == "ArCH" or
-                                             self.contact_name == "RC6H5"):
-
-            self.coordinate_file = self.coordinate_file.rsplit('.', 1)[0] + "_1."\
-                                   + self.coordinate_file.rsplit('.', 1)[1]
-
     def read_coord_file(self):
         """ Reads the first 100 lines of a csv file to count the atoms per fragment and per central
             group and which atom will get what label from the parameter file. """
@@ -1,6 +1,14 @@
 CUT_OFF_ZERO = 1e-10            # when to treat a low number as zero
-MAX_DATAFILE_SIZE = 500e6       # in bytes
+CHUNK_SIZE = 50000              # amount of fragments that is read from a coordinate file at once
+MEAN_TOLERANCE = 1e-5           # alignment to the mean stops if the mean rmse changes less than this value
+MAX_MEAN_ITERATIONS = 20        # maximum amount of times all fragments are aligned to the mean
 STANDARD_RES = 0.3              # standard binsize in angstrom
+MIN_RES = 0.2                   # smallest binsize of the density slider
+MAX_RES = 1.0                   # largest binsize of the density slider
+RES_STEP = 0.05                 # step between the binsizes of the density slider
 STANDARD_THRESHOLD = 0.1        # standard threshold is 10% of maximum bin
-RMSE_TEST = 0.1                 # if rmse central model higher than this value, the program will try to reset the labels
+RMSE_TEST = 0.1                 # if rmse central model higher than this value, the program warns that it fits badly
+TRIM_PROPORTION = 0.1           # fraction of the highest and lowest coordinates left out of the trimmed mean
+SYMMETRY_TOLERANCE = 0.3        # max difference in angstrom between distances of symmetric atoms
+KDTREE_MIN_ATOMS = 500          # central models with more atoms than this are put in a kd-tree to find the closest atom
 STANDARD_EXTRA_VDW = 0.5        # standard extra overlap is 0.5 Angstrom
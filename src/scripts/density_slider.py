@@ -15,10 +15,11 @@ import pandas as pd
 from matplotlib.widgets import Button, Slider
 from mpl_toolkits.mplot3d import Axes3D
 from constants.paths import WORKDIR
+from classes.DensityStore import DensityStore
 from classes.Settings import Settings
 from helpers.plot_functions import plot_fragment_colored, plot_density
 
-from constants.constants import STANDARD_THRESHOLD, STANDARD_RES
+from constants.constants import STANDARD_THRESHOLD, STANDARD_RES, MIN_RES, MAX_RES, RES_STEP
 
 
 def main():
@@ -34,13 +35,22 @@ def main():
     settings.set_threshold(STANDARD_THRESHOLD)
     settings.set_contact_reference_point(sys.argv[2])
 
-    avg_fragment = pd.read_csv(settings.get_avg_frag_filename())
+    try:
+        avg_fragment = pd.read_csv(settings.get_avg_frag_filename())
+        pyramid = DensityStore(settings, pyramid=True).open()
+    except (FileNotFoundError, KeyError) as exception:
+        print(exception)
+        print("Run avg_frag and calculate the density pyramid first")
+        sys.exit(1)
+
+    make_density_slider_plot(avg_fragment, pyramid, settings)
 
-    make_density_slider_plot(avg_fragment, settings)
 
+def make_density_slider_plot(avg_fragment, pyramid, settings):
+    """ Plots the density with sliders for the resolution and the threshold. The density of each resolution is taken
+        from the pyramid, so changing the resolution does not read or calculate anything. """
 
-def make_density_slider_plot(avg_fragment, settings):
-    df = pd.read_hdf(settings.get_density_df_filename(), settings.get_density_df_key())
+    df = pyramid.to_dataframe(settings.resolution)
     df[settings.contact_rp] = df[settings.contact_rp] / df[settings.contact_rp].sum()
 
     maximum = df[settings.contact_rp].max()
@@ -77,7 +87,7 @@ def make_density_slider_plot(avg_fragment, settings):
 
     axcolor = 'lightgoldenrodyellow'
     ax_resolution = plt.axes([0.25, 0.15, 0.65, 0.03], facecolor=axcolor)
-    resolution = Slider(ax_resolution, 'Res', 0.2, 1, valinit=settings.resolution, valstep=0.05)
+    resolution = Slider(ax_resolution, 'Res', MIN_RES, MAX_RES, valinit=settings.resolution, valstep=RES_STEP)
 
     ax_lowerlim = plt.axes([0.25, 0.1, 0.65, 0.03], facecolor=axcolor)
     lowerlim = Slider(ax_lowerlim, 'Lim', 0, 1, valinit=settings.threshold, valstep=0.01)
@@ -91,7 +101,7 @@ def make_density_slider_plot(avg_fragment, settings):
         print("\nChanged resolution to:", round(val, 2))
         settings.set_resolution(round(val, 2))
         print(f"Threshold: {settings.threshold}")
-        df = pd.read_hdf(settings.get_density_df_filename(), settings.get_density_df_key())
+        df = pyramid.to_dataframe(settings.resolution)
         df[settings.contact_rp] = df[settings.contact_rp] / df[settings.contact_rp].sum()
         maximum = df[settings.contact_rp].max()
 
@@ -126,7 +136,7 @@ def make_density_slider_plot(avg_fragment, settings):
         print("Resolution:", settings.resolution)
         global p
 
-        df = pd.read_hdf(settings.get_density_df_filename(), settings.get_density_df_key())
+        df = pyramid.to_dataframe(settings.resolution)
         df[settings.contact_rp] = df[settings.contact_rp] / df[settings.contact_rp].sum()
         maximum = df[settings.contact_rp].max()
 
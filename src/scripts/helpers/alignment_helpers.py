@@ -7,232 +7,425 @@
 # Author: Natasja Wezel
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
+import glob
+import io
+import os
+import time
+
+from itertools import islice
+
 import numpy as np
 import pandas as pd
 
+from classes.CoordinateCache import CoordinateCache
+from constants.constants import CHUNK_SIZE, SYMMETRY_TOLERANCE
+from helpers.superposition_helpers import calc_rmse_numba, kabsch_align_numba, qcp_align_numba, qcp_rmsd_numba
 
-def read_raw_data(filename, no_atoms):
-    """ Reads the raw datafiles making use of a logical function. One part reads the fragments their coordinates
-        and the other part reads the structure names. """
 
-    print("Pandas is reading csv..." + filename)
+def iter_fragment_chunks(filename, no_atoms, chunk_size=CHUNK_SIZE):
+    """ Generator that yields the coordinates, atom ids and structure ids of at most chunk_size fragments at a time.
+        They are loaded from the cache if the file was read before, else the file is parsed and cached. """
 
-    # use amount of atoms for skiprow function to read into df immediately
-    data = pd.read_csv(filename, sep='\\s+', usecols=[0, 1, 2, 3], names=['_id', 'x', 'y', 'z'],
-                       header=None,
-                       skiprows=lambda x: logic(x, no_atoms))
+    cache = CoordinateCache(filename, no_atoms)
 
-    # get the actual symbols of each atom
-    data['symbol'] = data.apply(lambda row: get_atom_symbol(row), axis=1)
+    if cache.is_valid():
+        print("Loading coordinates from cache..." + cache.folder)
+        yield from cache.iter_chunks(chunk_size)
+        return
 
-    # use amount of atoms for skiprow function to read only the structures from the data
-    structures = pd.read_csv(filename, sep='*', usecols=[0], names=['structure_id'],
-                             header=None,
-                             skiprows=lambda x: not logic(x, no_atoms))
+    print("Reading coordinates..." + filename)
 
-    structures['structure_id'] = structures['structure_id'].str.rstrip()
+    # only the time spent parsing counts, not the time the caller spends between the chunks
+    chunks = parse_fragment_chunks(filename, no_atoms, chunk_size)
+    duration, no_fragments = 0, 0
 
-    structures['rmse'] = 0
-    structures['mirrored'] = False
+    while True:
+        t0 = time.time()
+        chunk = next(chunks, None)
+        duration += time.time() - t0
+
+        if chunk is None:
+            break
+
+        cache.append(*chunk)
+        no_fragments += len(chunk[2])
+
+        yield chunk
+
+    cache.close()
+
+    megabytes = os.path.getsize(filename) / 1e6
+
+    # a small file can be read within the resolution of the timer, then there is no throughput
+    throughput = f" ({megabytes / duration :.1f} MB/s)" if duration > 0 else ""
+    print(f"Read {no_fragments} fragments, {megabytes :.1f} MB in {duration :.2f} s" + throughput)
+
+
+def parse_fragment_chunks(filename, no_atoms, chunk_size):
+    """ Generator that walks through the coordinate file once and yields the coordinates, atom ids and structure ids
+        of at most chunk_size fragments at a time. Each fragment has one header line and no_atoms atom lines. """
+
+    lines_per_fragment = no_atoms + 1
+
+    with open(filename, 'rb') as inputfile:
+        while True:
+            lines = list(islice(inputfile, chunk_size * lines_per_fragment))
+
+            no_fragments = len(lines) // lines_per_fragment
+
+            if len(lines) % lines_per_fragment != 0:
+                print(f"Ignoring {len(lines) % lines_per_fragment} lines of an incomplete fragment at the end of file")
+                del lines[no_fragments * lines_per_fragment:]
+
+            if no_fragments == 0:
+                return
+
+            # the header lines contain the structure id, followed by **FRAG**
+            headers = lines[::lines_per_fragment]
+            del lines[::lines_per_fragment]
+
+            structure_ids = [header.split(b'*', 1)[0].rstrip().decode() for header in headers]
+
+            # let pandas tokenize the atom lines in one go, only the atom id and its coordinates are used
+            atoms = pd.read_csv(io.BytesIO(b"".join(lines)), sep='\\s+', header=None, usecols=[0, 1, 2, 3])
+
+            coordinates = atoms[[1, 2, 3]].to_numpy(dtype=float).reshape(no_fragments, no_atoms, 3)
+            atom_ids = atoms[0].to_numpy(dtype=object).reshape(no_fragments, no_atoms)
 
-    print("Done")
+            yield coordinates, atom_ids, np.array(structure_ids, dtype=object)
 
-    return data, structures
 
+def get_atom_symbols(atom_ids):
+    """ Gets the symbols of an array of atom ids. Every unique atom id is only looked up once. """
 
-def get_atom_symbol(row):
-    """ Regex the row id to get the actual name of the element. """
+    inverse, unique_ids = pd.factorize(atom_ids.ravel())
+    symbols = np.array([get_atom_symbol(_id) for _id in unique_ids], dtype=object)
+
+    return symbols[inverse].reshape(atom_ids.shape)
+
+
+def get_atom_symbol(_id):
+    """ Regex the atom id to get the actual name of the element. """
 
     # if second symbol is a number, return only first character
-    if row._id[1] in '0123456789':
-        return row._id[:1]
+    if _id[1] in '0123456789':
+        return _id[:1]
 
     # else, its br, cl etc. so return first 2 characters
-    return row._id[:2]
+    return _id[:2]
+
+
+def bin_atoms(settings):
+    """ Removes the atoms that have to be thrown away from the settings. Returns the indices of the atoms in a fragment
+        of the coordinate file that are kept. """
+
+    keep_atoms = list(range(settings.no_atoms))
+
+    # TODO: decide if you want to give the posibility of ignoring atoms during alignment
+    # Then you would have to also add them again later.
+    if settings.alignment['bin'] != '-':
+        print(f"Throwing away {len(settings.alignment['bin'])} atoms.")
+        keep_atoms = [i for i, label in enumerate(settings.label_list) if label not in settings.alignment['bin']]
+
+        settings.no_atoms -= len(settings.alignment['bin'])
+        settings.no_atoms_central -= len(settings.alignment['bin'])
+
+        for label in settings.alignment['bin']:
+            settings.label_list.remove(label)
+
+    return keep_atoms
+
+
+def remove_alignment_outputs(settings):
+    """ Removes the outputs that are made from the aligned store: the coordinate df and the densities of all contact
+        reference points and resolutions. """
+
+    filenames = glob.glob(glob.escape(settings.outputfile_prefix) + "_density_*")
+    filenames.append(settings.get_coordinate_df_filename())
+
+    for filename in filenames:
+        if os.path.exists(filename):
+            os.remove(filename)
+
+
+def prepare_data(settings, chunk, keep_atoms):
+    """ Leaves out the binned atoms of a chunk of fragments from the coordinate file, and restructures the coordinates
+        into a matrix with one row per atom. """
+
+    coordinates, atom_ids, structure_ids = chunk
+    coordinates, atom_ids = coordinates[:, keep_atoms], atom_ids[:, keep_atoms]
+
+    data_matrix = coordinates.reshape(-1, 3)
+
+    structures = pd.DataFrame({'structure_id': structure_ids})
+
+    structures['rmse'] = 0
+    structures['mirrored'] = False
+
+    return structures, data_matrix, atom_ids
+
+
+def find_inliers(rmses, rmse_cutoff=None):
+    """ Returns which fragments have an rmse below the cutoff. """
+
+    if rmse_cutoff is None:
+        return np.ones(len(rmses), dtype=bool)
+
+    return rmses <= rmse_cutoff
+
+
+def find_rmse_cutoff(rmses, rmse_cutoff=None, rmse_quantile=None):
+    """ Returns the lowest of the absolute cutoff and the rmse_quantile of all rmses. """
+
+    assert 0 < rmse_quantile < 1, "The quantile must be between 0 and 1."
+
+    cutoff = np.quantile(rmses, rmse_quantile)
+
+    return cutoff if rmse_cutoff is None else min(cutoff, rmse_cutoff)
+
+
+def find_symmetry_permutations(A, labels, symbols, tolerance=SYMMETRY_TOLERANCE):
+    """ Finds the symmetries of central group A: the permutations of its atoms that only swap atoms of the same element
+        and keep all distances between the atoms the same within the tolerance. R atoms can be any element, so they are
+        only swapped with other R atoms. The identity is always the first permutation. """
+
+    kinds = ['R' if '-R' in label else symbol for label, symbol in zip(labels, symbols)]
+    distances = np.linalg.norm(A[:, np.newaxis] - A[np.newaxis], axis=2)
+
+    no_atoms_central = len(A)
+    permutations = []
+
+    def extend(permutation):
+        i = len(permutation)
+
+        if i == no_atoms_central:
+            permutations.append(permutation)
+            return
+
+        for j in range(no_atoms_central):
+            if j in permutation or kinds[j] != kinds[i]:
+                continue
+
+            # atom j can only take the place of atom i if it has the same distances to the atoms placed so far
+            if np.all(np.abs(distances[i, :i] - distances[j, permutation]) <= tolerance):
+                extend(permutation + [j])
+
+    extend([])
 
+    return np.array(permutations, dtype=int)
 
-def logic(index, amount_atoms):
-    """ Logic function to skip each header line - or read only the headers for the structure names - when reading
-        in the data. """
 
-    if index % (amount_atoms + 1) == 0:
-        return True
-        
-    return False
+def match_symmetric_atoms(A, fragments, atom_ids, permutations):
+    """ Reorders the central atoms of each fragment with the symmetry permutation that superimposes best onto central
+        group A, so every label belongs to the same atom of the central group in all fragments. Changes the fragments
+        and the atom ids in place, and returns how many fragments are reordered. """
 
+    if len(permutations) < 2 or len(fragments) == 0:
+        return 0
 
-def kabsch_align(A, B, B2, n):
-    """ Performs the kabsch algorithm on two central groups, then translates and multiplies the
-        entire fragment with the calculated translation vector and rotation matrix. """
+    no_atoms_central = permutations.shape[1]
 
-    assert len(A) == len(B), "Fragment 1 and fragment to align do not have the same length"
+    # rmsd after optimal superposition of every permutation of every fragment, with shape (permutations, fragments)
+    rmsds = np.stack([qcp_rmsd_numba(A, np.ascontiguousarray(fragments[:, permutation]), no_atoms_central)
+                      for permutation in permutations])
+
+    best = np.argmin(rmsds, axis=0)
+    order = permutations[best]
+
+    fragments[:, :no_atoms_central] = np.take_along_axis(fragments[:, :no_atoms_central], order[:, :, np.newaxis],
+                                                         axis=1)
+    atom_ids[:, :no_atoms_central] = np.take_along_axis(atom_ids[:, :no_atoms_central], order, axis=1)
+
+    return np.count_nonzero(best)
+
+
+def kabsch_align(A, B, B2):
+    """ Performs the kabsch algorithm on a stack of central groups B with shape (fragments, n, 3) at once, all onto
+        central group A. Then translates and multiplies each entire fragment in B2 with its calculated translation
+        vector and rotation matrix. """
+
+    assert A.shape == B.shape[1:], "Fragment 1 and fragments to align do not have the same length"
 
     # center the points
     centroid_A = np.mean(A, axis=0)
-    centroid_B = np.mean(B, axis=0)
-    AA = A - np.tile(centroid_A, (n, 1))
-    BB = B - np.tile(centroid_B, (n, 1))
+    centroid_B = np.mean(B, axis=1)
+    AA = A - centroid_A
+    BB = B - centroid_B[:, np.newaxis]
 
-    # np.dot is matrix multiplication for array
-    H = np.dot(np.transpose(BB), AA)
+    # covariance matrix of each fragment
+    H = np.matmul(BB.transpose(0, 2, 1), AA)
 
-    # decompose into singular values
+    # decompose all of them into singular values
     U, S, Vt = np.linalg.svd(H)
 
-    rotation_matrix = np.dot(Vt.T, U.T)
+    rotation_matrices = np.matmul(Vt.transpose(0, 2, 1), U.transpose(0, 2, 1))
 
     # special reflection case
-    if np.linalg.det(rotation_matrix) < 0:
-        Vt[2, :] *= -1
-        rotation_matrix = np.dot(Vt.T, U.T)
+    reflected = np.linalg.det(rotation_matrices) < 0
+    Vt[reflected, 2, :] *= -1
+    rotation_matrices[reflected] = np.matmul(Vt[reflected].transpose(0, 2, 1), U[reflected].transpose(0, 2, 1))
+
+    translation_vectors = centroid_A - np.einsum('fij,fj->fi', rotation_matrices, centroid_B)
+
+    return np.einsum('fij,faj->fai', rotation_matrices, B2) + translation_vectors[:, np.newaxis]
+
+
+def align_fragments(A, fragments, no_atoms_central, to_mirror, engine="numpy"):
+    """ Aligns a stack of fragments with shape (fragments, atoms, 3) onto central group A in place, mirrors them if
+        needed, and returns which fragments are mirrored and the rmse of each fragment. The engine is "numpy",
+        "numba", which uses the compiled kabsch kernels, or "qcp", which uses the compiled quaternion kernels. """
 
-    translation_vector = -np.dot(rotation_matrix, centroid_B.T) + centroid_A.T
+    assert engine in ["numpy", "numba", "qcp"], "Engine must be either numpy, numba or qcp."
 
-    n = B2.shape[0]
-    B2 = (np.dot(rotation_matrix, B2.T)) + np.tile(np.matrix(translation_vector).T, (1, n))
+    if engine == "numba":
+        kabsch_align_numba(A, fragments, no_atoms_central)
+    elif engine == "qcp":
+        qcp_align_numba(A, fragments, no_atoms_central)
+    else:
+        fragments[:] = kabsch_align(A, fragments[:, :no_atoms_central], fragments)
 
-    return B2.T
+    mirrored = np.zeros(len(fragments), dtype=bool)
+    if to_mirror:
+        mirrored, _ = mirror_fragments(fragments)
 
+    if engine in ["numba", "qcp"]:
+        return mirrored, calc_rmse_numba(A, fragments)
 
-def perform_translation(fragment, index_center):
-    """ Lays the atom on index_center on the origin and moves the rest of the atoms as well. """
+    return mirrored, calc_rmse(A, fragments[:, :no_atoms_central], A.shape[0])
 
-    translation_vec = np.array([-float(fragment[index_center][0]),
-                                -float(fragment[index_center][1]),
-                                -float(fragment[index_center][2])])
 
-    n = fragment.shape[0]
-    fragment = (fragment.T + np.tile(np.matrix(translation_vec).T, (1, n))).T
+def perform_translation(fragments, index_center):
+    """ Lays the atom on index_center on the origin and moves the rest of the atoms as well. Works on a stack of
+        fragments with shape (fragments, atoms, 3). """
 
-    return np.array(fragment)
+    return fragments - fragments[:, index_center, np.newaxis]
 
 
-def perform_rotations(fragment, labels):
+def perform_rotations(fragments, labels):
     """ Performs three rotations to lie three of the atoms in the xy plane, one of those
         on the x-axis.
         First rotation: puts first atom on xy-plane if it already was on a plane,
         and above the x-axis if it wasn't by rotating around the z-axis.
         Second rotation: puts first atom on x-axis by rotating around y-axis.
-        Third rotation: puts second atom in x-y plane by rotating around the x-axis. """
+        Third rotation: puts second atom in x-y plane by rotating around the x-axis.
+        Works on a stack of fragments with shape (fragments, atoms, 3). The angles are calculated for all fragments at
+        once, and the three rotations are composed into one rotation matrix per fragment. """
 
-    # calculate rotation angle based on atom
-    coord_vector = find_coord_vector(ax='z', atom=fragment[labels[0]])
-    angle = find_angles(ax='z', point_vector=coord_vector)
-    angle = angle * find_rotation_direction(ax='z', atom=fragment[labels[0]])
+    rotation_matrices = np.broadcast_to(np.identity(3), (len(fragments), 3, 3))
 
-    # rotate the entire fragment with that angle
-    fragment = calculate_rotation(fragment=fragment.copy(), angle=angle, ax='z')
+    for ax, label in [('z', labels[0]), ('y', labels[0]), ('x', labels[1])]:
+        # calculate rotation angle based on the atom as it is after the previous rotations
+        atoms = np.einsum('fi,fij->fj', fragments[:, label], rotation_matrices)
 
-    # Rotation 2
-    coord_vector = find_coord_vector(ax='y', atom=fragment[labels[0]])
-    angle = find_angles(ax='y', point_vector=coord_vector)
-    angle = angle * find_rotation_direction(ax='y', atom=fragment[labels[0]])
-    fragment = calculate_rotation(fragment=fragment.copy(), angle=angle, ax='y')
+        coord_vectors = find_coord_vectors(ax=ax, atoms=atoms)
+        angles = find_angles(ax=ax, point_vectors=coord_vectors)
+        angles = angles * find_rotation_directions(ax=ax, atoms=atoms)
 
-    # Rotation 3
-    coord_vector = find_coord_vector(ax='x', atom=fragment[labels[1]])
-    angle = find_angles(ax='x', point_vector=coord_vector)
-    angle = angle * find_rotation_direction(ax='x', atom=fragment[labels[1]])
-    fragment = calculate_rotation(fragment=fragment.copy(), angle=angle, ax='x')
+        rotation_matrices = np.matmul(rotation_matrices, get_rotation_matrices(angles=angles, ax=ax))
 
-    return fragment
+    # rotate all coordinates of each fragment with its rotation matrix
+    return np.einsum('fai,fij->faj', fragments, rotation_matrices)
 
 
-def find_coord_vector(ax, atom):
-    """ Finds the coordinate vector towards the atom and projects it onto a plane. """
+def find_coord_vectors(ax, atoms):
+    """ Finds the coordinate vectors towards the atoms and projects them onto a plane. """
 
-    coord_vector = np.copy(atom)
+    coord_vectors = np.copy(atoms)
     if ax == "x":
-        coord_vector[0] = 0
+        coord_vectors[:, 0] = 0
     elif ax == "y":
-        coord_vector[1] = 0
+        coord_vectors[:, 1] = 0
     else:
-        coord_vector[2] = 0
+        coord_vectors[:, 2] = 0
 
-    return coord_vector
+    return coord_vectors
 
 
-def find_rotation_direction(ax, atom):
-    """ Defines the direction of the rotation, clockwise or counter clockwise. """
+def find_rotation_directions(ax, atoms):
+    """ Defines the direction of the rotations, clockwise or counter clockwise. """
 
-    if ax == "x" and atom[2] < 0:
-        return -1
-    elif ax == "y" and atom[2] < 0:
-        return -1
-    elif ax == "z" and atom[1] < 0:
-        return -1
+    if ax == "z":
+        return np.where(atoms[:, 1] < 0, -1, 1)
 
-    return 1
+    return np.where(atoms[:, 2] < 0, -1, 1)
 
 
-def find_angles(point_vector, ax):
+def find_angles(point_vectors, ax):
     """ Rotates the molecule so that the contact fragment is always in the same position.
         Rotates only the important part of the molecule. """
 
     assert ax in ["x", "y", "z"], "Ax must be either x, y or z."
 
-    # x, y, z unitary row vectors:
-    x, y = np.array([1, 0, 0]), np.array([0, 1, 0])
+    norms = np.linalg.norm(point_vectors, axis=1)
 
-    norm = np.linalg.norm(point_vector)
+    # if x: angle with y axis (beta), if y or z: angle with x axis (alpha)
+    projections = point_vectors[:, 1] if ax == "x" else point_vectors[:, 0]
 
-    if norm < 1e-10:
-        return 0.0
-    elif ax == "x":
-        # return angle with y axis (beta)
-        return np.arccos(np.dot(point_vector, y) / norm)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        angles = np.arccos(np.clip(projections / norms, -1, 1))
 
-    # if y or z: return angle with x axis (alpha)
-    return np.arccos(np.dot(point_vector, x) / norm)
+    return np.where(norms < 1e-10, 0.0, angles)
 
 
-def calculate_rotation(fragment, angle, ax):
-    """ Calculate the actual rotation based on the axis and angle. """
+def get_rotation_matrices(angles, ax):
+    """ Get the rotation matrices based on the axis and the angles, with shape (angles, 3, 3). """
 
-    # get rotation matrix based on angle
     if ax == "x":
-        rotation_matrix = rotate_x(angle)
+        rotation_matrices = rotate_x(angles)
     elif ax == "y":
-        rotation_matrix = rotate_y(angle)
+        rotation_matrices = rotate_y(angles)
     else:
-        rotation_matrix = rotate_z(angle)
-
-    # rotate all coordinates with the rotation matrix
-    for i in range(len(fragment)):
-        fragment[i] = np.dot(fragment[i], rotation_matrix)
+        rotation_matrices = rotate_z(angles)
 
-    return fragment
+    return np.moveaxis(rotation_matrices, -1, 0)
 
 
 def rotate_x(angle):
     """ Rotation matrix for rotation around x-axis. """
 
-    return np.array(([1,             0,              0],
-                     [0,             np.cos(angle),  -np.sin(angle)],
-                     [0,             np.sin(angle),  np.cos(angle)]))
+    one, zero = np.ones_like(angle), np.zeros_like(angle)
+
+    return np.array(([one,           zero,           zero],
+                     [zero,          np.cos(angle),  -np.sin(angle)],
+                     [zero,          np.sin(angle),  np.cos(angle)]))
 
 
 def rotate_y(angle):
     """ Rotation matrix for rotation around y-axis. """
 
-    return np.array(([np.cos(angle),  0,              -np.sin(angle)],
-                     [0,              1,              0],
-                     [np.sin(angle),  0,              np.cos(angle)]))
+    one, zero = np.ones_like(angle), np.zeros_like(angle)
+
+    return np.array(([np.cos(angle),  zero,           -np.sin(angle)],
+                     [zero,           one,            zero],
+                     [np.sin(angle),  zero,           np.cos(angle)]))
 
 
 def rotate_z(angle):
     """ Rotation matrix for rotation around z-axis. """
 
-    return np.array(([np.cos(angle), -np.sin(angle), 0],
-                     [np.sin(angle), np.cos(angle),  0],
-                     [0,             0,              1]))
+    one, zero = np.ones_like(angle), np.zeros_like(angle)
+
+    return np.array(([np.cos(angle), -np.sin(angle), zero],
+                     [np.sin(angle), np.cos(angle),  zero],
+                     [zero,          zero,           one]))
+
+
+def mirror_fragments(fragments):
+    """ Mirrors all fragments in a stack of shape (fragments, atoms, 3) of which the mean of z is negative. """
+
+    mirrored = fragments[:, :, 2].mean(axis=1) < 0
+
+    # mirror by switching signs of z coordinate
+    fragments[mirrored, :, 2] *= -1
+
+    return mirrored, fragments
 
 
 def calc_rmse(A, B, n):
-    """ Calculate the RMSE of two matrices. """
+    """ Calculate the RMSE of two matrices. If B is a stack of matrices, calculates the RMSE of A with each of them. """
 
     err = A - B
     err = np.multiply(err, err)
-    err = np.sum(err)
+    err = np.sum(err, axis=(-2, -1))
 
     return np.sqrt(err / n)
@@ -14,6 +14,9 @@ import pandas as pd
 from numba import jit
 from numba import prange
 
+from classes.DensityStore import DensityStore
+from constants.constants import CHUNK_SIZE
+
 
 def calculate_no_bins(resolution, limits):
     """ Calculates the number of bins needed between a minimum and a maximum at a certain resolution.
@@ -32,113 +35,232 @@ def calculate_no_bins(resolution, limits):
 
 
 def make_density_df(settings, coordinate_df, again=False):
-    """ Make density df if it doesn't already exists. """
+    """ Make density df if it doesn't already exists. Only the bins that contain datapoints are stored, and are in the
+        df. """
 
-    try:
-        if again:
-            raise KeyError
-        density_df = pd.read_hdf(settings.get_density_df_filename(), settings.get_density_df_key())
-        print("Density df already existed, loaded from file")
-    except (FileNotFoundError, KeyError):
+    density_store = DensityStore(settings)
 
-        # prepare empty df
-        empty_density_df = prepare_df(df=coordinate_df, settings=settings)
+    if again or not density_store.exists():
 
         # count data per bin
-        density_df = count_data_points_per_bin(df=empty_density_df, contact_points_df=coordinate_df, settings=settings)
-
-        # normalize
-        density_df['datafrac_normalized'] = (density_df[settings.contact_rp] /
-                                             density_df[settings.contact_rp].sum())
+        bins, counts = count_data_points_per_bin(contact_points_df=coordinate_df, settings=settings)
 
         # save so we can use the data but only change the plot - saves time :)
-        density_df.to_hdf(settings.get_density_df_filename(), settings.get_density_df_key())
+        density_store.write([(settings.resolution, bins, counts)])
+    else:
+        print("Density df already existed, loaded from file")
+
+    return density_store.open().to_dataframe(settings.resolution)
+
+
+def make_density_pyramid(settings, coordinate_df, resolutions, again=False):
+    """ Make the density of every resolution in one pass over the datapoints, if it doesn't already exists. All levels
+        are in one store, which is returned without reading the counts. """
+
+    resolutions = np.round(np.asarray(resolutions, dtype=float), 2)
+    pyramid = DensityStore(settings, pyramid=True)
 
-    return density_df
+    if not again and pyramid.exists() and np.isin(resolutions, pyramid.open().resolutions).all():
+        print("Density pyramid already existed, loaded from file")
+    else:
+        # count data per bin, for all resolutions at once
+        pyramid.write(count_data_points_per_level(contact_points_df=coordinate_df, settings=settings,
+                                                  resolutions=resolutions))
 
+    return pyramid.open()
 
-def count_data_points_per_bin(df, contact_points_df, settings):
-    """ Counts the amount of datapoints that is in a bin. """
 
-    contact_points_df = contact_points_df
+def count_data_points_per_level(contact_points_df, settings, resolutions):
+    """ Counts the amount of datapoints per bin at every resolution. The bin indices of a datapoint for all
+        resolutions are found in the same pass over the datapoints, chunk by chunk, and are counted per level. Yields
+        the occupied bins and their counts per level. """
+
+    print(f"Counting points per bin for {len(resolutions)} resolutions: ")
+
+    contact_coordinates = contact_points_df[['x', 'y', 'z']].to_numpy(dtype=float)
+    minima, maxima = contact_coordinates.min(axis=0), contact_coordinates.max(axis=0)
+
+    # the starts of the bins of each axis and level, padded to the largest amount of bins
+    level_starts = [[make_axis_starts(resolution, [minima[axis], maxima[axis]]) for axis in range(3)]
+                    for resolution in resolutions]
+    no_bins = np.array([[len(axis_starts) for axis_starts, _ in level] for level in level_starts], dtype=np.int64)
+
+    starts = np.zeros((len(resolutions), 3, no_bins.max()), dtype=np.float32)
+    for i, level in enumerate(level_starts):
+        for axis, (axis_starts, _) in enumerate(level):
+            starts[i, axis, :len(axis_starts)] = axis_starts
+
+    level_counts = [np.zeros(np.prod(level_no_bins), dtype=np.int64) for level_no_bins in no_bins]
+
+    # the bin indices of all levels are only kept for one chunk of datapoints at a time
+    for start in range(0, len(contact_coordinates), CHUNK_SIZE):
+        bin_indices = find_level_bin_indices(contact_coordinates[start:start + CHUNK_SIZE], starts, no_bins,
+                                             resolutions)
+
+        if np.any(bin_indices < 0):
+            print("Oh no this is going wrong")
+
+        for i in range(len(resolutions)):
+            level_counts[i] += count_bin_indices(bin_indices[i], no_bins[i])
+
+    for i, resolution in enumerate(resolutions):
+        occupied = np.flatnonzero(level_counts[i])
+        counts = level_counts[i][occupied]
+        bins = to_bin_coordinates(occupied, no_bins[i], [origin for _, origin in level_starts[i]])
+
+        assert counts.sum() == len(contact_points_df), "Something went wrong with filling bins" + \
+            str(counts.sum()) + " " + str(len(contact_points_df))
+
+        yield resolution, bins, counts
+
+
+def count_data_points_per_bin(contact_points_df, settings):
+    """ Counts the amount of datapoints that is in a bin. Returns the integer coordinates of the bins that have
+        datapoints and the amount. The origin is in the middle of bin (0, 0, 0), so the center of a bin is at its
+        coordinates times the resolution. """
 
     print("Counting points per bin: ")
-    # prepare vector that will contain the amount
-    amount = np.zeros(len(df))
 
-    bin_coordinates = np.array([df.xstart, df.ystart, df.zstart])
-    contact_coordinates = np.transpose(np.array([contact_points_df.x,
-                                                 contact_points_df.y,
-                                                 contact_points_df.z]))
+    contact_coordinates = contact_points_df[['x', 'y', 'z']].to_numpy(dtype=float)
+
+    starts, origins = [], []
+    for axis in range(3):
+        axis_starts, origin = make_axis_starts(settings.resolution, [contact_coordinates[:, axis].min(),
+                                                                     contact_coordinates[:, axis].max()])
+        starts.append(axis_starts)
+        origins.append(origin)
+
+    no_bins = [len(axis_starts) for axis_starts in starts]
+    print(f"Amount of bins: {np.prod(no_bins)}")
 
-    amount = fill_bins(amount, bin_coordinates, contact_coordinates, settings.resolution)
+    bin_indices = find_bin_indices(contact_coordinates, starts, settings.resolution)
 
-    assert amount.sum() == len(contact_points_df), "Something went wrong with filling bins" + str(amount.sum())\
+    if np.any(bin_indices < 0):
+        print("Oh no this is going wrong")
+        print(contact_coordinates[bin_indices < 0])
+
+    bins, counts = count_occupied_bins(bin_indices, no_bins, origins)
+
+    assert counts.sum() == len(contact_points_df), "Something went wrong with filling bins" + str(counts.sum())\
         + " " + str(len(contact_points_df))
 
-    df[settings.contact_rp] = amount
+    print(f"Bins with datapoints: {len(bins)}")
 
-    return df
+    return bins, counts
 
 
-def fill_bins(amount, bin_coordinates, contact_coordinates, resolution):
-    """ Count how many datapoints there are in each bin. """
+def count_occupied_bins(bin_indices, no_bins, origins):
+    """ Counts the datapoints per bin index. Returns the integer coordinates of the bins that have datapoints, with
+        shape (bins, 3), and the amount. """
 
-    x, y, z = 0, 1, 2
-    i = 0
-    total = len(contact_coordinates)
+    counts = count_bin_indices(bin_indices, no_bins)
+    occupied = np.flatnonzero(counts)
 
-    for i in range(total):
-        cor = contact_coordinates[i]
-        cor = np.array([cor[x], cor[y], cor[z]], dtype='float32')
-        cor_res = np.array([cor[x] - resolution,
-                            cor[y] - resolution,
-                            cor[z] - resolution], dtype='float32')
+    return to_bin_coordinates(occupied, no_bins, origins), counts[occupied]
 
-        idx = np.where((bin_coordinates[x] <= cor[x]) & (cor_res[x] <= bin_coordinates[x]) &
-                       (bin_coordinates[y] <= cor[y]) & (cor_res[y] <= bin_coordinates[y]) &
-                       (bin_coordinates[z] <= cor[z]) & (cor_res[z] <= bin_coordinates[z]))
 
-        if len(idx[0]) > 1:
-            #  because of floating point imprecision, sometimes bins overlap, so get first bin
-            amount[idx[0][0]] += 1
-        elif len(idx[0]) == 0:
-            print("Oh no this is going wrong")
-            print(cor, cor_res)
-        else:
-            amount[idx] += 1
+def count_bin_indices(bin_indices, no_bins):
+    """ Counts the datapoints per bin index in linear time, as a flat array with an element for every bin. The array
+        is only used to count, only the occupied bins are stored. """
 
-        if i % 5000 == 0:
-            print(i, "/", total)
+    return np.bincount(bin_indices[bin_indices >= 0], minlength=int(np.prod(no_bins)))
 
-    return amount
 
+def to_bin_coordinates(occupied, no_bins, origins):
+    """ Turns bin indices into integer bin coordinates with shape (bins, 3), with the origin in bin (0, 0, 0). """
 
-def prepare_df(df, settings):
-    """ Prepares an empty df containing the coordinates for all the bins. """
+    bins = np.column_stack(np.unravel_index(occupied, tuple(no_bins))) - np.asarray(origins)
 
-    maxx, maxy, maxz = df.x.max(), df.y.max(), df.z.max()
-    minx, miny, minz = df.x.min(), df.y.min(), df.z.min()
+    return bins.astype(np.int32)
 
-    no_bins_x, minx, maxx = calculate_no_bins(resolution=settings.resolution, limits=[minx, maxx])
-    no_bins_y, miny, maxy = calculate_no_bins(resolution=settings.resolution, limits=[miny, maxy])
-    no_bins_z, minz, maxz = calculate_no_bins(resolution=settings.resolution, limits=[minz, maxz])
 
-    amount_bins = no_bins_x * no_bins_y * no_bins_z
+def make_axis_starts(resolution, limits):
+    """ Returns the starts of the bins along one axis between a minimum and a maximum, and the index of the bin with
+        the origin in the middle. """
 
-    print(f"Preparing df, amount of bins: {amount_bins}")
-    print(f"X Range: ({minx :.2f},{maxx :.2f}), Y Range: ({miny :.2f},{maxy :.2f}), Z Range: ({minz :.2f},{maxz :.2f})")
+    no_bins, minimum, maximum = calculate_no_bins(resolution=resolution, limits=limits)
 
-    indices = [i for i in range(0, amount_bins)]
+    starts = np.linspace(minimum, maximum, num=no_bins, endpoint=False).astype(np.float32)
+    origin = int(round(-minimum / resolution - 0.5))
 
-    bins = [np.linspace(minx, maxx, num=no_bins_x, endpoint=False),
-            np.linspace(miny, maxy, num=no_bins_y, endpoint=False),
-            np.linspace(minz, maxz, num=no_bins_z, endpoint=False)]
+    return starts, origin
 
-    df = add_boundaries_per_bin(bins, indices)
-    df[settings.contact_rp] = 0
 
-    return df
+def get_bin_centers(density_df, resolution):
+    """ Returns the coordinates of the centers of the bins in the density df. """
+
+    return density_df[['xbin', 'ybin', 'zbin']].to_numpy(dtype=float) * resolution
+
+
+def find_bin_indices(contact_coordinates, starts, resolution):
+    """ Returns the index of the bin of each datapoint, or -1 if it is in no bin. The bins along each axis are found
+        with index arithmetic, so the time does not depend on the amount of bins. """
+
+    no_bins = [len(axis_starts) for axis_starts in starts]
+    bin_indices = np.zeros(len(contact_coordinates), dtype=np.int64)
+
+    for axis in range(3):
+        axis_indices = find_axis_bins(contact_coordinates[:, axis], starts[axis], resolution)
+
+        bin_indices = np.where((bin_indices < 0) | (axis_indices < 0), -1, bin_indices * no_bins[axis] + axis_indices)
+
+    return bin_indices
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def find_axis_bins(coordinates, starts, resolution):
+    """ Finds the bin of each coordinate along one axis. """
+
+    indices = np.empty(len(coordinates), dtype=np.int64)
+
+    for i in prange(len(coordinates)):
+        indices[i] = find_bin(coordinates[i], starts, len(starts), resolution)
+
+    return indices
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def find_level_bin_indices(coordinates, starts, no_bins, resolutions):
+    """ Finds the index of the bin of each datapoint at every resolution, or -1 if it is in no bin. The starts and the
+        amount of bins are given per level and axis. """
+
+    bin_indices = np.empty((len(resolutions), len(coordinates)), dtype=np.int64)
+
+    for i in prange(len(coordinates)):
+        for level in range(len(resolutions)):
+            index = 0
+
+            for axis in range(3):
+                axis_index = find_bin(coordinates[i, axis], starts[level, axis], no_bins[level, axis],
+                                      resolutions[level])
+
+                if index < 0 or axis_index < 0:
+                    index = -1
+                else:
+                    index = index * no_bins[level, axis] + axis_index
+
+            bin_indices[level, i] = index
+
+    return bin_indices
+
+
+@jit(nopython=True, cache=True)
+def find_bin(coordinate, starts, no_starts, resolution):
+    """ Finds the bin of a coordinate along one axis, or -1 if it is in no bin. A coordinate is in a bin if the start
+        of the bin is between the coordinate minus the resolution and the coordinate, compared in float32 like the bin
+        starts. On the border of two bins, the first bin is chosen. """
+
+    coordinate = np.float32(coordinate)
+    lower = np.float32(np.float64(coordinate) - resolution)
+
+    # the bin from the index arithmetic, or one of its neighbours because of floating point imprecision
+    guess = int(np.floor((np.float64(coordinate) - np.float64(starts[0])) / resolution))
+
+    for j in range(max(guess - 1, 0), min(guess + 2, no_starts)):
+        if starts[j] <= coordinate and lower <= starts[j]:
+            return j
+
+    return -1
 
 
 def add_boundaries_per_bin(bins, indices):
@@ -2,13 +2,14 @@
 # This script is part of the quantification pipeline of 3D experimental data of crystal structures that I wrote for my
 # thesis in the Master Computational Science, University of Amsterdam, 2021.
 #
-# `general_helpers` contains a function for splitting large file and a check if label exists
+# `general_helpers` contains a check if label exists, a function to turn arrays of strings into categories and a
+# function to append an array to a binary file
 #
 # Author: Natasja Wezel
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 
-import os
-import csv
+import numpy as np
+import pandas as pd
 
 
 def check_if_label_exists(atom, fragment):
@@ -21,41 +22,17 @@ def check_if_label_exists(atom, fragment):
     return atom
 
 
-def split(filehandler, delimiter=',', row_limit=10000,
-          output_name_template='output_%s.csv', output_path='.'):
-    """
-    Splits a CSV file into multiple pieces.
+def to_codes(values, categories, dtype=np.int32):
+    """ Translates an array of strings to integer codes, adding unseen strings to the categories dictionary. """
 
-    A quick bastardization of the Python CSV library.
-    Arguments:
-        `row_limit`: The number of rows you want in each output file
-        `output_name_template`: A %s-style template for the numbered output files.
-        `output_path`: Where to stick the output files
-        `keep_headers`: Whether or not to print the headers in each output file.
-    Example usage:
+    codes, uniques = pd.factorize(values.ravel())
+    unique_codes = np.array([categories.setdefault(value, len(categories)) for value in uniques], dtype=dtype)
 
-        >> from toolbox import csv_splitter;
-        >> csv_splitter.split(csv.splitter(open('/home/ben/Desktop/lasd/2009-01-02 [00.00.00].csv', 'r')));
+    return unique_codes[codes].reshape(values.shape)
 
-    """
 
-    reader = csv.reader(filehandler, delimiter=delimiter)
-    current_piece = 1
-    current_out_path = os.path.join(output_name_template % current_piece)
+def write_array(filename, array):
+    """ Appends the raw contents of an array to a binary file, so a memory mapped array can be written in chunks. """
 
-    current_out_writer = csv.writer(open(current_out_path, 'w', newline=''))
-    current_limit = row_limit
-
-    for i, row in enumerate(reader):
-        if i + 1 > current_limit:
-            print(f"{current_piece}th file is done")
-
-            current_piece += 1
-            current_limit = row_limit * current_piece
-            current_out_path = os.path.join(output_name_template % current_piece)
-
-            current_out_writer = csv.writer(open(current_out_path, 'w', newline=''))
-
-        current_out_writer.writerow(row)
-
-    print(f"Splitted input into {current_piece} different files")
+    with open(filename, 'ab') as outputfile:
+        array.tofile(outputfile)
@@ -15,9 +15,14 @@ import copy
 import time
 
 from numba import jit
+from numba import prange
+from scipy.spatial import cKDTree
+from scipy.stats import trim_mean
 
+from constants.constants import CHUNK_SIZE, KDTREE_MIN_ATOMS, TRIM_PROPORTION
 
-def make_coordinate_df(df, settings, avg_fragment, radii, again=False):
+
+def make_coordinate_df(aligned, settings, avg_fragment, radii, again=False):
     try:
         if again:
             raise KeyError
@@ -27,39 +32,32 @@ def make_coordinate_df(df, settings, avg_fragment, radii, again=False):
         print("Searching for nearest atom from central group...")
         t0 = time.time()
 
-        df = df[df.label == "-"]
-
-        first_fragment_df = df[df.fragment_id == df.fragment_id.unique()[0]]
+        # only the contact groups are needed, they have the same amount of atoms in every fragment
+        atoms = aligned.get_atom_indices("contact")
 
-        print("Atoms in contact group:", len(first_fragment_df), "atom to count: ", settings.contact_rp)
-        find_closest_contact_atom = False
+        print("Atoms in contact group:", len(atoms), "atom to count: ", settings.contact_rp)
+        longest_vdw = radii.get_vdw_distance_contact(settings.contact_rp)
 
         if settings.contact_rp.lower() == "centroid":
             # plot centroids of all contact fragments
-            longest_vdw = radii.get_vdw_distance_contact(settings.contact_rp)
-            coordinate_df = df.groupby("fragment_id").mean().reset_index()
-
-        elif len(first_fragment_df[first_fragment_df["symbol"] == settings.contact_rp]) == 1:
-            longest_vdw = radii.get_vdw_distance_contact(settings.contact_rp)
-
-            # atom is unique, plot all of them
-            coordinate_df = df[df.symbol == settings.contact_rp].reset_index().copy()
+            coordinate_df = make_centroid_df(aligned, atoms)
+            coordinate_df['longest_vdw'] = longest_vdw
+            coordinate_df = distances_closest_vdw_central(coordinate_df, avg_fragment)
 
         else:
-            longest_vdw = radii.get_vdw_distance_contact(settings.contact_rp)
-            coordinate_df = df[df.symbol == settings.contact_rp].reset_index().copy()
-
-            # atom is not unique, find closest later
-            find_closest_contact_atom = True
+            # which contact atoms of each fragment have the symbol of the reference point
+            is_rp = aligned.symbol_codes[:, atoms] == list(aligned.symbols).index(settings.contact_rp) \
+                if settings.contact_rp in aligned.symbols else np.zeros((aligned.no_fragments, len(atoms)), dtype=bool)
 
-        coordinate_df = distances_closest_vdw_central(coordinate_df, avg_fragment)
+            coordinate_df = make_contact_atom_df(aligned, atoms, is_rp)
+            coordinate_df['longest_vdw'] = longest_vdw
+            coordinate_df = distances_closest_vdw_central(coordinate_df, avg_fragment)
 
-        if find_closest_contact_atom:
-            # find closest atom
-            coordinate_df = coordinate_df.loc[coordinate_df.groupby('fragment_id').distance.idxmin()]\
-                                         .reset_index(drop=True)
+            # if the atom is not unique, only keep the one closest to the central group
+            if np.count_nonzero(is_rp[0]) != 1:
+                closest = find_closest_contact_atoms(is_rp, coordinate_df.distance.to_numpy())
+                coordinate_df = coordinate_df.iloc[closest].reset_index(drop=True)
 
-        coordinate_df['longest_vdw'] = longest_vdw
         coordinate_df.to_hdf(settings.get_coordinate_df_filename(), settings.get_coordinate_df_key())
 
         t1 = time.time()
@@ -68,57 +66,146 @@ def make_coordinate_df(df, settings, avg_fragment, radii, again=False):
     return coordinate_df
 
 
-def distances_closest_vdw_central(coordinate_df, avg_fragment, labels=""):
-    length = len(coordinate_df)
+def make_centroid_df(aligned, atoms):
+    """ Returns a dataframe with the centroid of the contact group of every fragment, taken chunk by chunk over the
+        atom axis of the store. """
+
+    centroids = np.empty((aligned.no_fragments, 3))
+    for start in range(0, aligned.no_fragments, CHUNK_SIZE):
+        centroids[start:start + CHUNK_SIZE] = aligned.coordinates[start:start + CHUNK_SIZE, atoms].mean(axis=1)
+
+    return pd.DataFrame({'fragment_id': np.arange(aligned.no_fragments),
+                         'x': centroids[:, 0],
+                         'y': centroids[:, 1],
+                         'z': centroids[:, 2]})
+
 
-    # prepare numpy stuff
-    closest_distances = np.zeros(length)
-    closest_atoms_vdw = np.zeros(length)
+def make_contact_atom_df(aligned, atoms, is_rp):
+    """ Returns a dataframe with the contact atoms for which is_rp, with shape (fragments, contact atoms), is true. The
+        index column is the row the atom has in the dataframe of all atoms of the store. """
 
-    points_avg_f = np.array([avg_fragment.x, avg_fragment.y, avg_fragment.z]).T
-    vdw_radii = np.array(avg_fragment.vdw_radius)
+    fragment_ids, atom_indices = np.nonzero(is_rp)
+    coordinates = aligned.coordinates[fragment_ids, atoms[atom_indices]]
 
-    xcoord = np.array(coordinate_df.x)
-    ycoord = np.array(coordinate_df.y)
-    zcoord = np.array(coordinate_df.z)
+    return pd.DataFrame({'index': fragment_ids * aligned.no_atoms + atoms[atom_indices],
+                         'fragment_id': fragment_ids,
+                         '_id': aligned.ids[aligned.id_codes[fragment_ids, atoms[atom_indices]]],
+                         'symbol': aligned.symbols[aligned.symbol_codes[fragment_ids, atoms[atom_indices]]],
+                         'label': aligned.labels[atoms[atom_indices]],
+                         'x': coordinates[:, 0],
+                         'y': coordinates[:, 1],
+                         'z': coordinates[:, 2]})
 
-    # so we can use JIT for the distance calculation
-    closest_atoms_vdw, closest_distances = p_dist_calc(closest_atoms_vdw, closest_distances,
-                                                       xcoord, ycoord, zcoord,
-                                                       length, points_avg_f, vdw_radii)
+
+def find_closest_contact_atoms(is_rp, distances):
+    """ Returns the rows of the contact atoms that are closest to the central group, one for every fragment that has
+        any. The distances belong to the contact atoms for which is_rp, with shape (fragments, contact atoms), is true,
+        in the same order. """
+
+    grid = np.full(is_rp.shape, np.inf)
+    grid[is_rp] = distances
+
+    # the row of each contact atom in the distances, and the closest contact atom of each fragment
+    rows = np.cumsum(is_rp).reshape(is_rp.shape) - 1
+    closest = np.argmin(grid, axis=1)
+
+    fragments = np.flatnonzero(is_rp.any(axis=1))
+
+    return rows[fragments, closest[fragments]]
+
+
+def distances_closest_vdw_central(coordinate_df, avg_fragment, labels=""):
+    """ Adds the distance to the closest atom of the central model, its vdw radius and index, the vdw corrected
+        distance ('moved') and the distance to the second closest atom to the coordinate df. """
+
+    points = coordinate_df[['x', 'y', 'z']].to_numpy(dtype=float)
+
+    closest_atoms, closest_distances, moved, second_distances = \
+        find_closest_atoms(points, avg_fragment[['x', 'y', 'z']].to_numpy(), avg_fragment.vdw_radius.to_numpy(),
+                           coordinate_df.longest_vdw.iloc[0] if len(coordinate_df) > 0 else 0)
 
     # add the label to the column name for fingerprints: so they don't overwrite other columns
     coordinate_df.loc[:, "distance" + labels] = closest_distances
-    coordinate_df.loc[:, "vdw_closest_atom" + labels] = closest_atoms_vdw
+    coordinate_df.loc[:, "vdw_closest_atom" + labels] = avg_fragment.vdw_radius.to_numpy()[closest_atoms]
+    coordinate_df.loc[:, "closest_atom" + labels] = closest_atoms
+    coordinate_df.loc[:, "moved" + labels] = moved
+    coordinate_df.loc[:, "second_distance" + labels] = second_distances
 
     return coordinate_df
 
 
-@jit(nopython=True)
-def p_dist_calc(closest_atoms_vdw, closest_distances, xcoord, ycoord, zcoord, length, points_avg_f, vdw_radii):
+def find_closest_atoms(points, model_points, vdw_radii, contact_vdw):
+    """ Returns for each point the index of the closest atom of the model, the distance to that atom, the distance
+        corrected for the vdw radii of that atom and of the contact atom, and the distance to the second closest atom.
+        The results have the same precision as the points, so float32 points halve the memory needed. Small models
+        are compared to every point, large models are put in a kd-tree. """
+
+    model_points, vdw_radii = model_points.astype(points.dtype), vdw_radii.astype(points.dtype)
+
+    if len(model_points) > KDTREE_MIN_ATOMS:
+        distances, atoms = cKDTree(model_points).query(points, k=2, workers=-1)
+        closest_atoms, closest_distances = atoms[:, 0], distances[:, 0].astype(points.dtype)
+
+        return closest_atoms, closest_distances, closest_distances - vdw_radii[closest_atoms] - contact_vdw, \
+            distances[:, 1].astype(points.dtype)
+
+    closest_atoms = np.empty(len(points), dtype=np.int64)
+    closest_distances = np.empty(len(points), dtype=points.dtype)
+    moved = np.empty(len(points), dtype=points.dtype)
+    second_distances = np.empty(len(points), dtype=points.dtype)
+
+    closest_atoms_kernel(points, model_points, vdw_radii, points.dtype.type(contact_vdw), closest_atoms,
+                         closest_distances, moved, second_distances)
 
-    for idx in range(length):
+    return closest_atoms, closest_distances, moved, second_distances
 
-        # grab x, y and z of current contact from np arrays
-        contact_point = np.array([xcoord[idx], ycoord[idx], zcoord[idx]])
 
-        # set distance to infinite so you'll find a lower distance soon
-        min_dist = 1000000000
-        min_atom_vdw = None
+@jit(nopython=True, parallel=True, cache=True)
+def closest_atoms_kernel(points, model_points, vdw_radii, contact_vdw, closest_atoms, closest_distances, moved,
+                         second_distances):
+    """ Fills the output arrays in one pass over the points, without allocating anything per point. """
 
-        # calc distance with every avg fragment point, remember shortest one
-        for i, avg_fragment_point in enumerate(points_avg_f):
-            t_dist = np.sqrt(np.sum((avg_fragment_point - contact_point)**2, axis=0))
+    for idx in prange(len(points)):
+        min_dist, second_dist = np.inf, np.inf
+        closest = 0
+
+        # compare squared distances, only the two closest distances need a square root
+        for i in range(len(model_points)):
+            t_dist = (points[idx, 0] - model_points[i, 0])**2 + (points[idx, 1] - model_points[i, 1])**2 + \
+                (points[idx, 2] - model_points[i, 2])**2
 
-            # also remember the vdw radius of the closest atom
             if t_dist < min_dist:
+                second_dist = min_dist
                 min_dist = t_dist
-                min_atom_vdw = vdw_radii[i]
+                closest = i
+            elif t_dist < second_dist:
+                second_dist = t_dist
+
+        closest_atoms[idx] = closest
+        closest_distances[idx] = np.sqrt(min_dist)
+        moved[idx] = closest_distances[idx] - vdw_radii[closest] - contact_vdw
+        second_distances[idx] = np.sqrt(second_dist)
+
+
+def fingerprint_distances(points, model_points, vdw_radii, contact_vdw, masks, block_size=CHUNK_SIZE):
+    """ Returns the vdw corrected distance of each point to the closest atom of every subset of the model atoms, with
+        shape (subsets, points). The subsets are given as boolean masks over the model atoms. The distances to all
+        atoms are calculated once per block of points, and each subset takes its minimum from them. """
 
-        closest_distances[idx] = min_dist
-        closest_atoms_vdw[idx] = min_atom_vdw
+    moved = np.empty((len(masks), len(points)))
 
-    return closest_atoms_vdw, closest_distances
+    for start in range(0, len(points), block_size):
+        block = points[start:start + block_size]
+        rows = np.arange(len(block))
+
+        # distance to every atom of the model, with shape (points, atoms)
+        distances = np.linalg.norm(block[:, np.newaxis] - model_points[np.newaxis], axis=2)
+
+        for i, mask in enumerate(masks):
+            closest_atoms = np.argmin(np.where(mask, distances, np.inf), axis=1)
+            moved[i, start:start + block_size] = distances[rows, closest_atoms] - vdw_radii[closest_atoms] - contact_vdw
+
+    return moved
 
 
 def get_dihedral_and_h(CSV, central_name):
@@ -143,7 +230,6 @@ def add_model_methyl(CSV, fragment, settings, radii):
 
     methyl_model = get_dihedral_and_h(CSV, settings.central_name)
 
-    # if labels have been switched by kmeans, look at old labels
     column = "label"
 
     a = np.array([float(fragment[fragment[column].str.contains(methyl_model['dihedral1'])].x),
@@ -223,61 +309,111 @@ def rotation_from_axis_and_angle(axis, angle, rot_vec):
     return np.dot(rot_mat, rot_vec)
 
 
-def average_fragment(df, settings, radii):
-    """ Returns a fragment containing the average points of the central groups. """
+def average_fragment(aligned, radii, method="mean"):
+    """ Returns a fragment containing the average points of the central groups. Every fragment has the same atoms in
+        the same order, so each atom is averaged over the fragment axis of the store. The method is "mean", "median"
+        or "trimmed", the mean without the highest and lowest TRIM_PROPORTION of the coordinates. """
+
+    assert method in ["mean", "median", "trimmed"], "Method must be either mean, median or trimmed."
 
-    central_group_df = df[df['label'] != '-']
+    atoms = aligned.get_atom_indices("central")
 
-    # take average R vdw radius
-    counts = central_group_df[central_group_df['label'].str.contains("R")]['symbol'].value_counts()
+    if method == "mean":
+        # the mean can be taken chunk by chunk, so the store is never loaded at once
+        total = np.zeros((len(atoms), 3))
+        for start in range(0, aligned.no_fragments, CHUNK_SIZE):
+            total += aligned.coordinates[start:start + CHUNK_SIZE, atoms].sum(axis=0)
+
+        coordinates = total / aligned.no_fragments
+    else:
+        coordinates = calc_average(aligned.coordinates[:, atoms], method)
+
+    # every label has the symbol of the atom in the first fragment
+    avg_fragment_df = pd.DataFrame({'label': aligned.labels[atoms],
+                                    'symbol': aligned.symbols[aligned.symbol_codes[0, atoms]],
+                                    'x': coordinates[:, 0],
+                                    'y': coordinates[:, 1],
+                                    'z': coordinates[:, 2]})
+
+    return add_radii(avg_fragment_df, count_R_elements(aligned), radii)
+
+
+def calc_average(coordinates, method="mean"):
+    """ Averages coordinates over the first axis with the method "mean", "median" or "trimmed". """
+
+    if method == "median":
+        return np.median(coordinates, axis=0)
+    elif method == "trimmed":
+        return trim_mean(coordinates, TRIM_PROPORTION, axis=0)
+
+    return np.mean(coordinates, axis=0)
+
+
+def count_R_elements(aligned):
+    """ Counts how often each element is found on the place of an R atom in the store, most common element first. """
+
+    atoms = aligned.get_atom_indices("central")
+    R_atoms = atoms[["R" in label for label in aligned.labels[atoms]]]
+
+    counts = np.zeros(len(aligned.symbols), dtype=np.int64)
+    for start in range(0, aligned.no_fragments, CHUNK_SIZE):
+        counts += np.bincount(aligned.symbol_codes[start:start + CHUNK_SIZE, R_atoms].ravel(),
+                              minlength=len(aligned.symbols))
+
+    counts = pd.Series(counts, index=aligned.symbols)
+
+    return counts[counts > 0].sort_values(ascending=False, kind="stable")
+
+
+def add_radii(avg_fragment_df, counts, radii):
+    """ Adds the vdw and covalent radius of each atom to the average fragment. The R atoms get the average radii of
+        the elements in counts, which holds how often each element is found on the place of R. """
+
+    vdw_radii = radii.lookup(avg_fragment_df.symbol, "vdw")
+    cov_radii = radii.lookup(avg_fragment_df.symbol, "cov")
 
     if len(counts) > 0:
         # TODO: what happens if multiple R?
-        if 'kmeans_label' not in central_group_df.columns:
-            print("\nR consists of:")
-            elements = counts.index.to_list()
-            counts_list = counts.to_list()
-            percentages = [count/np.sum(counts) for count in counts_list]
-
-            for element in elements[:5]:
-                print(element.ljust(10), end="")
-            print("other      ")
-            for percentage in percentages[:5]:
-                print(f"{percentage * 100 :.2f}%    ".ljust(10), end="")
-            print(f'{np.sum(percentages[5:] * 100) :.2f}%\n')
-
-        vdw, cov = 0, 0
-        atoms = 0
-        for i, count in counts.items():
-            atoms += count
-            vdw += count * radii.get_vdw_radius(i)
-            cov += count * radii.get_cov_radius(i)
-        avg_vdw = vdw / atoms
-        avg_cov = cov / atoms
-
-    if 'kmeans_label' not in central_group_df.columns:
-        # sort must be false to preserve the order of the rows/labels
-        avg_fragment_df = central_group_df.groupby('label', sort=False).agg({'symbol': 'first',
-                                                                             'x': 'mean',
-                                                                             'y': 'mean',
-                                                                             'z': 'mean'}).reset_index()
-    else:
-        # sort must be false to preserve the order of the rows/labels
-        avg_fragment_df = central_group_df.groupby('kmeans_label', sort=False).agg({'symbol': 'first',
-                                                                                    'label': 'first',
-                                                                                    'x': 'mean',
-                                                                                    'y': 'mean',
-                                                                                    'z': 'mean'}).reset_index()
-
-    avg_fragment_df["vdw_radius"] = 0
-    avg_fragment_df["cov_radius"] = 0
-
-    for idx, row in avg_fragment_df.iterrows():
-        if "R" in row.label:
-            avg_fragment_df.loc[idx, "vdw_radius"] = avg_vdw
-            avg_fragment_df.loc[idx, "cov_radius"] = avg_cov
-        else:
-            avg_fragment_df.loc[idx, "vdw_radius"] = radii.get_vdw_radius(row.symbol)
-            avg_fragment_df.loc[idx, "cov_radius"] = radii.get_cov_radius(row.symbol)
+        print("\nR consists of:")
+        elements = counts.index.to_list()
+        percentages = counts.to_numpy() / np.sum(counts)
+
+        for element in elements[:5]:
+            print(element.ljust(10), end="")
+        print("other      ")
+        for percentage in percentages[:5]:
+            print(f"{percentage * 100 :.2f}%    ".ljust(10), end="")
+        print(f'{np.sum(percentages[5:] * 100) :.2f}%\n')
+
+        # weigh the radii of the elements by how often they are found
+        is_R = avg_fragment_df.label.str.contains("R").to_numpy()
+        vdw_radii[is_R] = np.average(radii.lookup(elements, "vdw"), weights=counts)
+        cov_radii[is_R] = np.average(radii.lookup(elements, "cov"), weights=counts)
+
+    avg_fragment_df["vdw_radius"] = vdw_radii
+    avg_fragment_df["cov_radius"] = cov_radii
 
     return avg_fragment_df
+
+
+@jit(nopython=True)
+def assign_nearest_centres(points, centres):
+    """ Returns the index of the nearest centre of each point, and the squared distance to that centre. """
+
+    nearest = np.zeros(len(points), dtype=np.int64)
+    squared_distances = np.empty(len(points))
+
+    for idx in range(len(points)):
+        min_dist = np.inf
+
+        for i in range(len(centres)):
+            t_dist = (points[idx, 0] - centres[i, 0])**2 + (points[idx, 1] - centres[i, 1])**2 + \
+                (points[idx, 2] - centres[i, 2])**2
+
+            if t_dist < min_dist:
+                min_dist = t_dist
+                nearest[idx] = i
+
+        squared_distances[idx] = min_dist
+
+    return nearest, squared_distances
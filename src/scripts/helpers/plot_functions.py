@@ -12,11 +12,11 @@ import numpy as np
 
 from mpl_toolkits.mplot3d import Axes3D
 
+from helpers.density_helpers import get_bin_centers
+
 
 def plot_density(ax, df, settings):
-    df['ymiddle'] = (df['ystart'] * 2 + settings.resolution) / 2
-    df['xmiddle'] = (df['xstart'] * 2 + settings.resolution) / 2
-    df['zmiddle'] = (df['zstart'] * 2 + settings.resolution) / 2
+    df['xmiddle'], df['ymiddle'], df['zmiddle'] = get_bin_centers(df, settings.resolution).T
 
     # normalize column
     df[settings.contact_rp + "_normalized"] = df[settings.contact_rp] / df[settings.contact_rp].sum()
@@ -0,0 +1,437 @@
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+# This script is part of the quantification pipeline of 3D experimental data of crystal structures that I wrote for my
+# thesis in the Master Computational Science, University of Amsterdam, 2021.
+#
+# `superposition_helpers` contains compiled kernels that superimpose all fragments onto a central group in parallel,
+# without the overhead of numpy calls per fragment. There are two methods: kabsch with a jacobi svd, and the
+# quaternion characteristic polynomial (QCP) method of Theobald.
+#
+# Author: Natasja Wezel
+# # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
+
+import numpy as np
+
+from numba import jit
+from numba import prange
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def kabsch_align_numba(A, fragments, no_atoms_central):
+    """ Performs the kabsch algorithm on the central groups of a stack of fragments with shape (fragments, atoms, 3),
+        and rotates and translates each entire fragment onto central group A in place. """
+
+    n = A.shape[0]
+    centroid_A = calc_centroid(A, n)
+
+    for f in prange(fragments.shape[0]):
+        B = fragments[f]
+        centroid_B = calc_centroid(B, no_atoms_central)
+
+        # covariance matrix of the centered central groups
+        H = np.zeros((3, 3))
+        for a in range(n):
+            for i in range(3):
+                for j in range(3):
+                    H[i, j] += (B[a, i] - centroid_B[i]) * (A[a, j] - centroid_A[j])
+
+        rotation_matrix = kabsch_rotation(H)
+
+        # rotate around the centroid of the central group and move it onto the centroid of A
+        for a in range(B.shape[0]):
+            x, y, z = B[a, 0] - centroid_B[0], B[a, 1] - centroid_B[1], B[a, 2] - centroid_B[2]
+
+            for i in range(3):
+                B[a, i] = rotation_matrix[i, 0] * x + rotation_matrix[i, 1] * y + rotation_matrix[i, 2] * z + \
+                    centroid_A[i]
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def calc_rmse_numba(A, fragments):
+    """ Calculate the RMSE of central group A with the first atoms of each fragment in the stack. """
+
+    n = A.shape[0]
+    rmses = np.empty(fragments.shape[0])
+
+    for f in prange(fragments.shape[0]):
+        err = 0.0
+        for a in range(n):
+            for i in range(3):
+                diff = A[a, i] - fragments[f, a, i]
+                err += diff * diff
+
+        rmses[f] = np.sqrt(err / n)
+
+    return rmses
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def qcp_align_numba(A, fragments, no_atoms_central):
+    """ Superimposes the central groups of a stack of fragments with shape (fragments, atoms, 3) onto central group A
+        with the QCP method, and rotates and translates each entire fragment in place. """
+
+    n = A.shape[0]
+    centroid_A = calc_centroid(A, n)
+
+    for f in prange(fragments.shape[0]):
+        B = fragments[f]
+        centroid_B = calc_centroid(B, no_atoms_central)
+
+        H, E0 = calc_inner_products(A, B, centroid_A, centroid_B, n)
+
+        if is_almost_collinear(H):
+            rotation_matrix = kabsch_rotation(H)
+        else:
+            K = make_key_matrix(H)
+            rotation_matrix = qcp_rotation(H, K, find_largest_eigenvalue(H, K, E0))
+
+        for a in range(B.shape[0]):
+            x, y, z = B[a, 0] - centroid_B[0], B[a, 1] - centroid_B[1], B[a, 2] - centroid_B[2]
+
+            for i in range(3):
+                B[a, i] = rotation_matrix[i, 0] * x + rotation_matrix[i, 1] * y + rotation_matrix[i, 2] * z + \
+                    centroid_A[i]
+
+
+@jit(nopython=True, parallel=True, cache=True)
+def qcp_rmsd_numba(A, fragments, no_atoms_central):
+    """ Calculates the RMSD of each fragment in the stack after an optimal superposition onto central group A, without
+        making the rotation matrix or changing the fragments. """
+
+    n = A.shape[0]
+    centroid_A = calc_centroid(A, n)
+    rmsds = np.empty(fragments.shape[0])
+
+    for f in prange(fragments.shape[0]):
+        B = fragments[f]
+        centroid_B = calc_centroid(B, no_atoms_central)
+
+        H, E0 = calc_inner_products(A, B, centroid_A, centroid_B, n)
+
+        if is_almost_collinear(H):
+            rmsds[f] = calc_rmsd_with_rotation(A, B, centroid_A, centroid_B, kabsch_rotation(H), n)
+        else:
+            largest_eigenvalue = find_largest_eigenvalue(H, make_key_matrix(H), E0)
+            rmsds[f] = np.sqrt(max(0.0, 2 * (E0 - largest_eigenvalue) / n))
+
+    return rmsds
+
+
+@jit(nopython=True, cache=True)
+def calc_centroid(matrix, n):
+    centroid = np.zeros(3)
+
+    for a in range(n):
+        for i in range(3):
+            centroid[i] += matrix[a, i]
+
+    return centroid / n
+
+
+@jit(nopython=True, cache=True)
+def kabsch_rotation(H):
+    """ Finds the rotation matrix of the kabsch algorithm from covariance matrix H = U S V^T, which is R = V U^T. V and
+        the singular values follow from the eigendecomposition of H^T H, the columns of U from H v / s. The last column
+        of U is the cross product of the first two, so U is a proper rotation and the reflection case is handled by
+        the sign of the determinant of V. """
+
+    M = np.zeros((3, 3))
+    for i in range(3):
+        for j in range(3):
+            M[i, j] = H[0, i] * H[0, j] + H[1, i] * H[1, j] + H[2, i] * H[2, j]
+
+    eigenvalues, V = jacobi_eigen(M)
+
+    u1 = multiply_column(H, V, 0)
+    u1 /= np.sqrt(np.sum(u1**2))
+
+    # make the second column orthogonal to the first, also if the central group is (almost) on a line
+    u2 = multiply_column(H, V, 1)
+    u2 -= np.sum(u1 * u2) * u1
+    norm = np.sqrt(np.sum(u2**2))
+
+    if norm < 1e-10 * np.sqrt(eigenvalues[0]):
+        u2 = cross(u1, np.array([1.0, 0.0, 0.0]) if abs(u1[0]) < 0.9 else np.array([0.0, 1.0, 0.0]))
+        norm = np.sqrt(np.sum(u2**2))
+
+    u2 /= norm
+    u3 = cross(u1, u2)
+
+    # special reflection case
+    if determinant_3x3(V) < 0:
+        V[:, 2] *= -1
+
+    rotation_matrix = np.zeros((3, 3))
+    for i in range(3):
+        for j in range(3):
+            rotation_matrix[i, j] = V[i, 0] * u1[j] + V[i, 1] * u2[j] + V[i, 2] * u3[j]
+
+    return rotation_matrix
+
+
+@jit(nopython=True, cache=True)
+def calc_inner_products(A, B, centroid_A, centroid_B, n):
+    """ Calculates the covariance matrix H of the centered central groups, and E0, the mean of their inner products. """
+
+    H = np.zeros((3, 3))
+    E0 = 0.0
+
+    for a in range(n):
+        for i in range(3):
+            b_i = B[a, i] - centroid_B[i]
+            a_i = A[a, i] - centroid_A[i]
+            E0 += (a_i * a_i + b_i * b_i) / 2
+
+            for j in range(3):
+                H[i, j] += b_i * (A[a, j] - centroid_A[j])
+
+    return H, E0
+
+
+@jit(nopython=True, cache=True)
+def is_almost_collinear(H):
+    """ Checks if the second singular value of H is almost zero, compared to the first. Then the largest eigenvalue of
+        the key matrix is (almost) double, and newton's method and the eigenvector are not precise. The sum of the
+        squared 2x2 minors of H is s1^2 s2^2 + s1^2 s3^2 + s2^2 s3^2. """
+
+    M = np.zeros((3, 3))
+    for i in range(3):
+        for j in range(3):
+            M[i, j] = H[0, i] * H[0, j] + H[1, i] * H[1, j] + H[2, i] * H[2, j]
+
+    trace = M[0, 0] + M[1, 1] + M[2, 2]
+    minors = (trace**2 - np.sum(M**2)) / 2
+
+    return minors < 1e-6 * trace**2
+
+
+@jit(nopython=True, cache=True)
+def calc_rmsd_with_rotation(A, B, centroid_A, centroid_B, rotation_matrix, n):
+    err = 0.0
+
+    for a in range(n):
+        for i in range(3):
+            rotated = 0.0
+            for j in range(3):
+                rotated += rotation_matrix[i, j] * (B[a, j] - centroid_B[j])
+
+            diff = A[a, i] - centroid_A[i] - rotated
+            err += diff * diff
+
+    return np.sqrt(err / n)
+
+
+@jit(nopython=True, cache=True)
+def make_key_matrix(H):
+    """ The symmetric 4x4 key matrix of which the largest eigenvector is the quaternion of the best rotation. """
+
+    K = np.empty((4, 4))
+
+    K[0, 0] = H[0, 0] + H[1, 1] + H[2, 2]
+    K[1, 1] = H[0, 0] - H[1, 1] - H[2, 2]
+    K[2, 2] = -H[0, 0] + H[1, 1] - H[2, 2]
+    K[3, 3] = -H[0, 0] - H[1, 1] + H[2, 2]
+
+    K[0, 1] = K[1, 0] = H[1, 2] - H[2, 1]
+    K[0, 2] = K[2, 0] = H[2, 0] - H[0, 2]
+    K[0, 3] = K[3, 0] = H[0, 1] - H[1, 0]
+    K[1, 2] = K[2, 1] = H[0, 1] + H[1, 0]
+    K[1, 3] = K[3, 1] = H[2, 0] + H[0, 2]
+    K[2, 3] = K[3, 2] = H[1, 2] + H[2, 1]
+
+    return K
+
+
+@jit(nopython=True, cache=True)
+def find_largest_eigenvalue(H, K, E0, max_iterations=50):
+    """ Finds the largest eigenvalue of the key matrix with newton's method on its characteristic polynomial
+        x^4 + c2 x^2 + c1 x + c0, starting from E0, which is an upper bound. """
+
+    c2 = -2 * np.sum(H**2)
+    c1 = -8 * determinant_3x3(H)
+    c0 = determinant_4x4(K)
+
+    eigenvalue = E0
+    for iteration in range(max_iterations):
+        previous = eigenvalue
+
+        x2 = eigenvalue * eigenvalue
+        b = (x2 + c2) * eigenvalue
+        a = b + c1
+        derivative = 2 * x2 * eigenvalue + b + a
+
+        # the polynomial is increasing above the largest root, if it is not the root is (almost) double and rounding
+        # errors dominate, so the current value is as precise as it gets
+        if derivative <= 0:
+            break
+
+        eigenvalue -= (a * eigenvalue + c0) / derivative
+
+        if abs(eigenvalue - previous) < 1e-11 * abs(eigenvalue):
+            break
+
+    return eigenvalue
+
+
+@jit(nopython=True, cache=True)
+def qcp_rotation(H, K, eigenvalue):
+    """ Makes the rotation matrix from the eigenvector of the key matrix that belongs to the largest eigenvalue. Any
+        column of the adjugate of K - eigenvalue I is such an eigenvector, the largest is the most precise. If they are
+        all (almost) zero, the eigenvalue is not unique and the rotation follows from kabsch instead. """
+
+    M = K.copy()
+    for i in range(4):
+        M[i, i] -= eigenvalue
+
+    adjugate = adjugate_4x4(M)
+
+    column, largest = 0, 0.0
+    for j in range(4):
+        norm = adjugate[0, j]**2 + adjugate[1, j]**2 + adjugate[2, j]**2 + adjugate[3, j]**2
+
+        if norm > largest:
+            column, largest = j, norm
+
+    if largest <= 1e-12 * np.sum(K**2)**3:
+        return kabsch_rotation(H)
+
+    norm = np.sqrt(largest)
+    w, x, y, z = adjugate[0, column] / norm, adjugate[1, column] / norm, adjugate[2, column] / norm, \
+        adjugate[3, column] / norm
+
+    rotation_matrix = np.empty((3, 3))
+
+    rotation_matrix[0, 0] = w * w + x * x - y * y - z * z
+    rotation_matrix[1, 1] = w * w - x * x + y * y - z * z
+    rotation_matrix[2, 2] = w * w - x * x - y * y + z * z
+
+    rotation_matrix[0, 1] = 2 * (x * y - w * z)
+    rotation_matrix[1, 0] = 2 * (x * y + w * z)
+    rotation_matrix[0, 2] = 2 * (x * z + w * y)
+    rotation_matrix[2, 0] = 2 * (x * z - w * y)
+    rotation_matrix[1, 2] = 2 * (y * z - w * x)
+    rotation_matrix[2, 1] = 2 * (y * z + w * x)
+
+    return rotation_matrix
+
+
+@jit(nopython=True, cache=True)
+def adjugate_4x4(M):
+    """ Adjugate of a 4x4 matrix, with the 2x2 minors of the first two and the last two rows. """
+
+    s0, s1, s2, s3, s4, s5 = minors_2x2(M, 0, 1)
+    c0, c1, c2, c3, c4, c5 = minors_2x2(M, 2, 3)
+
+    adjugate = np.empty((4, 4))
+
+    adjugate[0, 0] = M[1, 1] * c5 - M[1, 2] * c4 + M[1, 3] * c3
+    adjugate[0, 1] = -M[0, 1] * c5 + M[0, 2] * c4 - M[0, 3] * c3
+    adjugate[0, 2] = M[3, 1] * s5 - M[3, 2] * s4 + M[3, 3] * s3
+    adjugate[0, 3] = -M[2, 1] * s5 + M[2, 2] * s4 - M[2, 3] * s3
+
+    adjugate[1, 0] = -M[1, 0] * c5 + M[1, 2] * c2 - M[1, 3] * c1
+    adjugate[1, 1] = M[0, 0] * c5 - M[0, 2] * c2 + M[0, 3] * c1
+    adjugate[1, 2] = -M[3, 0] * s5 + M[3, 2] * s2 - M[3, 3] * s1
+    adjugate[1, 3] = M[2, 0] * s5 - M[2, 2] * s2 + M[2, 3] * s1
+
+    adjugate[2, 0] = M[1, 0] * c4 - M[1, 1] * c2 + M[1, 3] * c0
+    adjugate[2, 1] = -M[0, 0] * c4 + M[0, 1] * c2 - M[0, 3] * c0
+    adjugate[2, 2] = M[3, 0] * s4 - M[3, 1] * s2 + M[3, 3] * s0
+    adjugate[2, 3] = -M[2, 0] * s4 + M[2, 1] * s2 - M[2, 3] * s0
+
+    adjugate[3, 0] = -M[1, 0] * c3 + M[1, 1] * c1 - M[1, 2] * c0
+    adjugate[3, 1] = M[0, 0] * c3 - M[0, 1] * c1 + M[0, 2] * c0
+    adjugate[3, 2] = -M[3, 0] * s3 + M[3, 1] * s1 - M[3, 2] * s0
+    adjugate[3, 3] = M[2, 0] * s3 - M[2, 1] * s1 + M[2, 2] * s0
+
+    return adjugate
+
+
+@jit(nopython=True, cache=True)
+def minors_2x2(M, p, q):
+    """ The six 2x2 minors of rows p and q of a 4x4 matrix. """
+
+    return (M[p, 0] * M[q, 1] - M[q, 0] * M[p, 1],
+            M[p, 0] * M[q, 2] - M[q, 0] * M[p, 2],
+            M[p, 0] * M[q, 3] - M[q, 0] * M[p, 3],
+            M[p, 1] * M[q, 2] - M[q, 1] * M[p, 2],
+            M[p, 1] * M[q, 3] - M[q, 1] * M[p, 3],
+            M[p, 2] * M[q, 3] - M[q, 2] * M[p, 3])
+
+
+@jit(nopython=True, cache=True)
+def determinant_3x3(M):
+    return M[0, 0] * (M[1, 1] * M[2, 2] - M[1, 2] * M[2, 1]) - \
+        M[0, 1] * (M[1, 0] * M[2, 2] - M[1, 2] * M[2, 0]) + \
+        M[0, 2] * (M[1, 0] * M[2, 1] - M[1, 1] * M[2, 0])
+
+
+@jit(nopython=True, cache=True)
+def determinant_4x4(M):
+    """ Determinant of a 4x4 matrix, with the 2x2 minors of the first two and the last two rows. """
+
+    s0, s1, s2, s3, s4, s5 = minors_2x2(M, 0, 1)
+    c0, c1, c2, c3, c4, c5 = minors_2x2(M, 2, 3)
+
+    return s0 * c5 - s1 * c4 + s2 * c3 + s3 * c2 - s4 * c1 + s5 * c0
+
+
+@jit(nopython=True, cache=True)
+def multiply_column(H, V, k):
+    """ Matrix vector product of H and column k of V. """
+
+    u = np.zeros(3)
+    for i in range(3):
+        u[i] = H[i, 0] * V[0, k] + H[i, 1] * V[1, k] + H[i, 2] * V[2, k]
+
+    return u
+
+
+@jit(nopython=True, cache=True)
+def cross(u, v):
+    return np.array([u[1] * v[2] - u[2] * v[1], u[2] * v[0] - u[0] * v[2], u[0] * v[1] - u[1] * v[0]])
+
+
+@jit(nopython=True, cache=True)
+def jacobi_eigen(M, max_sweeps=50):
+    """ Eigenvalues and eigenvectors of a symmetric 3x3 matrix with cyclic Jacobi rotations, sorted from large to
+        small. The eigenvectors are the columns of the returned matrix. """
+
+    M = M.copy()
+    V = np.eye(3)
+
+    for sweep in range(max_sweeps):
+        off_diagonal = M[0, 1]**2 + M[0, 2]**2 + M[1, 2]**2
+        diagonal = M[0, 0]**2 + M[1, 1]**2 + M[2, 2]**2
+
+        if off_diagonal <= 1e-32 * diagonal:
+            break
+
+        for p, q in ((0, 1), (0, 2), (1, 2)):
+            if M[p, q] == 0:
+                continue
+
+            # rotation that makes M[p, q] zero
+            theta = (M[q, q] - M[p, p]) / (2 * M[p, q])
+            t = 1 / (abs(theta) + np.sqrt(theta**2 + 1))
+            if theta < 0:
+                t = -t
+
+            c = 1 / np.sqrt(t**2 + 1)
+            s = t * c
+
+            for k in range(3):
+                m_kp, m_kq = M[k, p], M[k, q]
+                M[k, p], M[k, q] = c * m_kp - s * m_kq, s * m_kp + c * m_kq
+
+            for k in range(3):
+                m_pk, m_qk = M[p, k], M[q, k]
+                M[p, k], M[q, k] = c * m_pk - s * m_qk, s * m_pk + c * m_qk
+
+            for k in range(3):
+                v_kp, v_kq = V[k, p], V[k, q]
+                V[k, p], V[k, q] = c * v_kp - s * v_kq, s * v_kp + c * v_kq
+
+    eigenvalues = np.array([M[0, 0], M[1, 1], M[2, 2]])
+    order = np.argsort(eigenvalues)[::-1]
+
+    return eigenvalues[order], V[:, order].copy()
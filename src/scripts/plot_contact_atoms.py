@@ -14,6 +14,7 @@ import matplotlib.pyplot as plt
 from matplotlib.widgets import Slider
 from mpl_toolkits.mplot3d import Axes3D
 
+from classes.AlignedFragments import AlignedFragments
 from classes.Settings import Settings
 from classes.Radii import Radii
 from helpers.geometry_helpers import (make_coordinate_df)
@@ -36,20 +37,19 @@ def main():
     settings = Settings(WORKDIR, sys.argv[1])
     settings.set_contact_reference_point(sys.argv[2])
 
-    df = pd.read_csv(settings.get_aligned_csv_filename())
+    aligned = AlignedFragments(settings).open()
 
     avg_fragment = pd.read_csv(settings.get_avg_frag_filename())
 
     radii = Radii(settings.get_radii_csv_name())
-    coordinate_df = make_coordinate_df(df, settings, avg_fragment, radii)
+    coordinate_df = make_coordinate_df(aligned, settings, avg_fragment, radii)
 
-    make_contact_rps_plot(avg_fragment, coordinate_df, settings)
+    make_contact_rps_plot(avg_fragment, coordinate_df, settings, radii)
 
 
-def make_contact_rps_plot(avg_fragment, coordinate_df, settings):
+def make_contact_rps_plot(avg_fragment, coordinate_df, settings, radii):
     """ Plot all the surrounding contact groups around the central group. """
 
-    radii = Radii(settings.get_radii_csv_name())
     vdw_distance_contact = radii.get_vdw_distance_contact(settings.contact_rp)
 
     title = "Central fragment: " + settings.central_name + "\n" +\
@@ -16,6 +16,7 @@ import matplotlib.pyplot as plt
 import pandas as pd
 from mpl_toolkits.mplot3d import Axes3D
 
+from classes.DensityStore import DensityStore
 from classes.Settings import Settings
 from helpers.plot_functions import plot_density, plot_fragment_colored, plot_vdw_spheres
 
@@ -38,7 +39,7 @@ def main():
 
     try:
         avg_fragment = pd.read_csv(settings.get_avg_frag_filename())
-        density_df = pd.read_hdf(settings.get_density_df_filename(), settings.get_density_df_key())
+        density_df = DensityStore(settings).open().to_dataframe(settings.resolution)
     except (FileNotFoundError, KeyError) as exception:
         print(exception)
         print("Run avg_frag and calc_density first")
@@ -12,12 +12,12 @@ import time
 
 import pandas as pd
 
+from classes.AlignedFragments import AlignedFragments
 from classes.Settings import Settings
 from classes.Radii import Radii
 from classes.Fingerprint import Fingerprint
 
-from helpers.geometry_helpers import (make_coordinate_df)
-from helpers.geometry_helpers import distances_closest_vdw_central
+from helpers.geometry_helpers import fingerprint_distances, make_coordinate_df
 
 from constants.paths import WORKDIR
 from constants.constants import STANDARD_EXTRA_VDW
@@ -35,41 +35,31 @@ def main():
     settings.set_contact_reference_point(sys.argv[2])
 
     try:
-        df = pd.read_csv(settings.get_aligned_csv_filename(), header=0)
+        aligned = AlignedFragments(settings).open()
         avg_frag = pd.read_csv(settings.outputfile_prefix + "_avg_fragment.csv", header=0)
     except FileNotFoundError:
         print('First align and calculate average fragment.')
         sys.exit(2)
 
-    make_fingerprint_plots(df, avg_frag, settings, STANDARD_EXTRA_VDW)
+    radii = Radii(settings.get_radii_csv_name())
+    make_fingerprint_plots(aligned, avg_frag, settings, radii, STANDARD_EXTRA_VDW)
     t1 = time.time() - t0
     print("Duration: %.2f s." % t1)
 
 
-def make_fingerprint_plots(df, avg_frag, settings, STANDARD_EXTRA_VDW):
+def make_fingerprint_plots(aligned, avg_frag, settings, radii, STANDARD_EXTRA_VDW):
     fingerprint = Fingerprint(settings)
 
-    radii = Radii(settings.get_radii_csv_name())
-    coordinate_df = make_coordinate_df(df, settings, avg_frag, radii)
-    coordinate_df['moved'] = coordinate_df['distance'] - coordinate_df['vdw_closest_atom']\
-        - coordinate_df['longest_vdw']
+    coordinate_df = make_coordinate_df(aligned, settings, avg_frag, radii)
 
-    # make first the fingerprint plot with everything
-    fingerprint.make_plot(coordinate_df, STANDARD_EXTRA_VDW)
-    fingerprint.next()
+    # the distances of all fingerprints are calculated in one pass, the first one uses all atoms of the model
+    masks = fingerprint.get_masks(avg_frag.label)
+    moved = fingerprint_distances(coordinate_df[['x', 'y', 'z']].to_numpy(dtype=float),
+                                  avg_frag[['x', 'y', 'z']].to_numpy(dtype=float), avg_frag.vdw_radius.to_numpy(),
+                                  coordinate_df.longest_vdw.iloc[0], masks)
 
     while fingerprint.not_done():
-        avg_frag_f = avg_frag[avg_frag.label.isin(fingerprint.get_label_list())]
-        labels = fingerprint.get_labels()
-
-        coordinate_df_f = distances_closest_vdw_central(coordinate_df, avg_frag_f, labels)
-
-        coordinate_df_f['moved'] = coordinate_df_f['distance' + labels]\
-            - coordinate_df_f['vdw_closest_atom' + labels]\
-            - coordinate_df_f['longest_vdw']
-
-        fingerprint.make_plot(coordinate_df_f, STANDARD_EXTRA_VDW)
-
+        fingerprint.make_plot(moved[fingerprint.counter + 1], coordinate_df.vdw_closest_atom.max(), STANDARD_EXTRA_VDW)
         fingerprint.next()
 
 
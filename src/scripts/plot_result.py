@@ -9,11 +9,12 @@
 
 import sys
 
-import pandas as pd
-
+from classes.AlignedFragments import AlignedFragments
+from classes.Settings import Settings
 from helpers.plot_functions import plot_fragments
 
 from constants.colors import COLORS
+from constants.paths import WORKDIR
 
 
 def main():
@@ -21,18 +22,14 @@ def main():
         print("Usage: python run.py <inputfilename> <fragments_to_plot>")
         sys.exit(1)
 
-    filename = sys.argv[1]
-    title = filename.rsplit('\\')[-1].rsplit('.', 1)[0]
-    central = title.split("_")[0]
-    contact = title.split("_")[1]
-
-    df = pd.read_csv('../../results/pairs/' + central + '/' + central + "_" + contact + "_vdw.5/"
-                     + central + "_" + contact + "_aligned.csv")
-
-    df = df[df.label != '-']
+    settings = Settings(WORKDIR, sys.argv[1])
+    aligned = AlignedFragments(settings).open()
 
     amount = int(sys.argv[2])
 
+    # only read the central groups of the fragments that are plotted
+    df = aligned.to_dataframe("central", slice(0, amount))
+
     plot_fragments(df, amount, COLORS)
 
 
@@ -98,15 +98,16 @@ def plot_fragment_with_labels(settings):
         ax.scatter(x, y, z, s=100, edgecolors="black", color=color, label=label)
         ax.text(x+0.1, y+0.1, z+0.1, labels[i])
 
+    # look up the covalent radii of all atoms at once
+    cov_radii = Radii('../files/radii.csv').lookup([atom[:1] for atom in atoms], "cov")
+
     for i, atom in enumerate(atoms):
         x1, y1, z1 = dictionary[atom][0], dictionary[atom][1], dictionary[atom][2]
         for i2, atom2 in enumerate(atoms[i:]):
             x2, y2, z2 = dictionary[atom2][0], dictionary[atom2][1], dictionary[atom2][2]
             distance = ((x1 - x2)**2 + (y1 - y2)**2 + (z1 - z2)**2)**0.5
 
-            radii = Radii('../files/radii.csv')
-
-            if distance < (radii.get_cov_radius(atom[:1]) + radii.get_cov_radius(atom2[:1]) + 0.01):
+            if distance < (cov_radii[i] + cov_radii[i + i2] + 0.01):
                 plt.plot([x1, x2], [y1, y2], [z1, z2], color='grey')
 
     # make cubic